@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Measures the overhead of the steps: every benchmark scripts the fake daemon
+(log lines, command output, files, processes), runs real steps against it
+through the docker client and reports the wall time, Docker API requests
+and bytes transferred of every step.
+
+    python benchmarks/bench_steps.py [-n RUNS] [-k FILTER] [--latency SECONDS]
+                                     [--json FILE] [--baseline FILE] [--tolerance RATIO]
+
+With --baseline the results are compared with a JSON file written earlier
+with --json and the exit code is 1 when any step makes more API requests
+than before or its median time grew more than --tolerance (relative) plus
+the API latency. This is meant to run in CI.
+"""
+import argparse
+import http.server
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+STEPS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "steps")
+
+sys.path.insert(0, STEPS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# the client of the benchmark daemon is created by the steps on first use
+os.environ['CTF_CONTAINER_ENGINE'] = 'docker'
+os.environ.setdefault('CTF_WAIT_TIME', '10')
+os.environ.setdefault('CTF_PROCESS_WAIT_TIME', '2')
+
+from behave.configuration import Configuration
+from behave.model import Step, Table
+from behave.runner import Context, Runner
+from behave.step_registry import registry
+
+import engine
+from fake_daemon import FakeDaemon
+from fake_engine import FakeEngine
+
+# importing the modules registers their steps
+import container_steps  # noqa: F401
+import steps  # noqa: F401
+import xml_steps  # noqa: F401
+
+IMAGE = 'bench/image:latest'
+
+CONFIG_XML = """<?xml version="1.0"?>
+<server xmlns="urn:bench">
+  <port name="http">8080</port>
+  <port name="https">8443</port>
+  <datasource jndi="java:/ds">  ExampleDS  </datasource>
+</server>
+"""
+
+
+class Benchmark(object):
+    """
+    A list of (step type, step text, table) to run against a daemon
+    prepared by setup(engine, env), env is a dict which is used to format
+    the step texts (e.g. with the port of the local HTTP server)
+    """
+
+    def __init__(self, name, steps, setup=None):
+        self.name = name
+        self.steps = steps
+        self.setup = setup
+
+
+def _common(engine, env):
+    engine.add_image(IMAGE, labels={'name': 'bench'})
+    engine.add_process('java')
+    engine.add_log('Starting the server')
+    engine.add_file('/opt/server/conf/config.xml', CONFIG_XML)
+    engine.add_file('/opt/server/conf/standalone.conf', 'JAVA_OPTS=-Xmx512m\n')
+    engine.add_file('/opt/server/bin/run.sh', '#!/bin/sh\n')
+    engine.add_file('/opt/server/bin/launch', link='run.sh')
+
+
+def _logs(engine, env):
+    _common(engine, env)
+    for i in range(2000):
+        engine.add_log('INFO [org.example.Service%d] service %d started' % (i % 50, i))
+    engine.add_log('WFLYSRV0025: Server started in 1234ms', delay=0.5)
+
+
+def _commands(engine, env):
+    _common(engine, env)
+    engine.on_exec(r'^echo ', 'hello\n')
+    engine.on_exec(r'^find ', '')
+
+
+START = ('when', 'container is started with command /opt/server/bin/run.sh', None)
+
+BENCHMARKS = [
+    Benchmark('start', [START], _common),
+    Benchmark('logs', [
+        START,
+        ('then', 'container log should contain WFLYSRV0025', None),
+        ('then', 'container log should match regex Server started in \\d+ms', None),
+        ('then', 'exactly 1 times container log should contain WFLYSRV0025', None),
+        ('then', 'available container log should contain Starting the server', None),
+        ('then', 'available container log should not contain ERROR', None),
+        ('then', 'container log should contain all of',
+         Table(['type', 'value'], rows=[['message', 'Service7'], ['regex', 'service \\d+ started']])),
+        ('then', 'available container log should contain none of',
+         Table(['type', 'value'], rows=[['message', 'ERROR'], ['regex', 'Exception\\b']])),
+    ], _logs),
+    Benchmark('commands', [
+        START,
+        ('then', 'run echo hello in container and check its output for hello', None),
+        ('then', 'run echo hello in container and immediately check its output does not contain bye', None),
+        ('then', 'all files under /opt/server are writeable by current user', None),
+    ], _commands),
+    Benchmark('files', [
+        START,
+        ('then', 'file /opt/server/conf/config.xml should exist', None),
+        ('then', 'file /opt/server/bin should exist and be a directory', None),
+        ('then', 'file /opt/server/bin/launch should exist and be a symlink', None),
+        ('then', 'file /opt/server/missing should not exist', None),
+        ('then', 'file /opt/server/conf/standalone.conf should contain Xmx512m', None),
+    ], _common),
+    Benchmark('cached files', [
+        START,
+        ('when', 'container files under /opt/server are cached', None),
+        ('then', 'file /opt/server/conf/config.xml should exist', None),
+        ('then', 'file /opt/server/bin/launch should exist and be a symlink', None),
+        ('then', 'file /opt/server/conf/standalone.conf should contain Xmx512m', None),
+    ], _common),
+    Benchmark('xml', [
+        START,
+        ('given', 'XML namespace b:urn:bench', None),
+        ('then', 'XML file /opt/server/conf/config.xml should contain value 8080 on XPath //b:port[@name="http"]/text()', None),
+        ('then', 'XML file /opt/server/conf/config.xml should contain trimmed value ExampleDS on XPath //b:datasource/text()', None),
+        ('then', 'XML file /opt/server/conf/config.xml should have 2 elements on XPath //b:port', None),
+    ], _common),
+    Benchmark('ports', [
+        START,
+        ('then', 'check that port {http_port} is open', None),
+        ('then', 'the following endpoints become available',
+         Table(['port', 'path', 'expected_phrase'], rows=[['{http_port}', '/health', 'UP']])),
+        ('then', 'check that page is served',
+         Table(['property', 'value'], rows=[['port', '{http_port}'], ['path', '/health'], ['expected_phrase', 'UP']])),
+    ], _common),
+]
+
+
+class _HealthHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = b'{"status": "UP"}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_context(name):
+    """ Returns a behave context with the attributes the steps use, as a scenario has it """
+    config = Configuration(command_args=[], load_config=False)
+    config.userdata['IMAGE'] = IMAGE
+    context = Context(Runner(config))
+    context._push()
+    context.scenario = types.SimpleNamespace(name=name, effective_tags=[])
+    context.containers = []
+    context.variables = {}
+    context.table = None
+    context.text = None
+    return context
+
+
+def run_benchmark(daemon, benchmark, env):
+    """ Runs the benchmark once, returns a list of per step results """
+    daemon.engine = FakeEngine()
+    if benchmark.setup:
+        benchmark.setup(daemon.engine, env)
+
+    context = create_context(benchmark.name)
+    results = []
+    try:
+        for step_type, template, table in benchmark.steps:
+            text = template.format(**env)
+            if table is not None:
+                table = Table(table.headings, rows=[[cell.format(**env) for cell in row] for row in table])
+            step = Step('<benchmark>', 0, step_type.capitalize(), step_type, text, table=table)
+            match = registry.find_match(step)
+            if match is None:
+                raise Exception("No step matches '%s %s'" % (step_type, text))
+
+            context.table = table
+            daemon.reset_stats()
+            start = time.time()
+            match.run(context)
+            elapsed = time.time() - start
+            # the step is reported with the placeholders, so that it matches the baseline
+            results.append(dict(daemon.stats(), step='%s %s' % (step_type, template), time=elapsed))
+    finally:
+        for container in context.containers:
+            container.stop()
+
+    return results
+
+
+def summarize(runs):
+    """ Merges the per step results of all runs of a benchmark """
+    summary = []
+    for results in zip(*runs):
+        times = [result['time'] for result in results]
+        last = results[-1]
+        summary.append({
+            'step': last['step'],
+            'median': statistics.median(times),
+            'min': min(times),
+            'max': max(times),
+            'requests': last['requests'],
+            'bytes_in': sum(last['bytes_in'].values()),
+            'bytes_out': sum(last['bytes_out'].values()),
+        })
+    return summary
+
+
+def print_report(report):
+    for name, summary in report.items():
+        print("\n%s" % name)
+        for result in summary:
+            requests = ", ".join("%s=%s" % item for item in sorted(result['requests'].items()))
+            print("  %8.1f ms  %4d requests  %9d B out  %7d B in  %s" % (
+                result['median'] * 1000, sum(result['requests'].values()),
+                result['bytes_out'], result['bytes_in'], result['step']))
+            print("               %s" % requests)
+
+
+def compare(report, baseline, tolerance, latency):
+    """ Returns descriptions of the steps which got slower or chattier than in the baseline """
+    regressions = []
+    for name, summary in report.items():
+        old_steps = dict((result['step'], result) for result in baseline.get(name, []))
+        for result in summary:
+            old = old_steps.get(result['step'])
+            if not old:
+                continue
+            calls, old_calls = sum(result['requests'].values()), sum(old['requests'].values())
+            if calls > old_calls:
+                regressions.append("%s: %s makes %s API requests instead of %s" % (
+                    name, result['step'], calls, old_calls))
+            # every request may take up to the latency longer on a slow machine
+            limit = old['median'] * (1 + tolerance) + latency * max(old_calls, 1) + 0.005
+            if result['median'] > limit:
+                regressions.append("%s: %s takes %.1f ms instead of %.1f ms" % (
+                    name, result['step'], result['median'] * 1000, old['median'] * 1000))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the steps against a fake Docker daemon")
+    parser.add_argument('-n', '--runs', type=int, default=5, help="runs of every benchmark")
+    parser.add_argument('-k', '--filter', help="run only benchmarks with this in their name")
+    parser.add_argument('--latency', type=float, default=0.0, help="delay of every API request in seconds")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare the results with this file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative slowdown")
+    args = parser.parse_args()
+    json_file = args.json and os.path.abspath(args.json)
+    baseline_file = args.baseline and os.path.abspath(args.baseline)
+
+    workdir = tempfile.mkdtemp(prefix='ctf-bench-')
+    # logs of the stopped containers are saved to the current directory
+    os.chdir(workdir)
+
+    daemon = FakeDaemon(os.path.join(workdir, 'docker.sock'), default_latency=args.latency)
+    daemon.start()
+    os.environ['DOCKER_HOST'] = daemon.base_url
+    engine.set_client(None)
+
+    http_server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _HealthHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    env = {'http_port': http_server.server_address[1]}
+
+    report = {}
+    try:
+        for benchmark in BENCHMARKS:
+            if args.filter and args.filter not in benchmark.name:
+                continue
+            runs = [run_benchmark(daemon, benchmark, env) for _ in range(args.runs)]
+            report[benchmark.name] = summarize(runs)
+    finally:
+        http_server.shutdown()
+        daemon.stop()
+
+    print_report(report)
+
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if baseline_file:
+        with open(baseline_file) as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.latency)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import base64
+import collections
+import json
+import os
+import re
+import socketserver
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+import docker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "steps"))
+
+from fake_engine import FakeEngine
+
+# (method, path regex, FakeEngine method) of the served Docker API endpoints
+ROUTES = [
+    ('GET', r'/version', 'version'),
+    ('GET', r'/_ping', 'ping'),
+    ('POST', r'/containers/create', 'create_container'),
+    ('POST', r'/containers/([^/]+)/start', 'start'),
+    ('POST', r'/containers/([^/]+)/kill', 'kill'),
+    ('DELETE', r'/containers/([^/]+)', 'remove_container'),
+    ('GET', r'/containers/([^/]+)/json', 'inspect_container'),
+    ('GET', r'/containers/([^/]+)/logs', 'logs'),
+    ('POST', r'/containers/([^/]+)/attach', 'attach'),
+    ('GET', r'/containers/([^/]+)/top', 'top'),
+    ('GET', r'/containers/([^/]+)/archive', 'get_archive'),
+    ('HEAD', r'/containers/([^/]+)/archive', 'stat_archive'),
+    ('PUT', r'/containers/([^/]+)/archive', 'put_archive'),
+    ('POST', r'/containers/([^/]+)/exec', 'exec_create'),
+    ('POST', r'/exec/([^/]+)/start', 'exec_start'),
+    ('GET', r'/exec/([^/]+)/json', 'exec_inspect'),
+    ('GET', r'/images/(.+)/json', 'inspect_image'),
+    ('GET', r'/images/(.+)/history', 'history'),
+    ('POST', r'/images/(.+)/tag', 'tag'),
+    ('DELETE', r'/images/(.+)', 'remove_image'),
+]
+
+
+class FakeDaemon(object):
+    """
+    Serves a FakeEngine through the Docker API on a unix socket, so the real
+    docker client (and every layer above it) is used by the steps. Requests
+    of every endpoint are delayed by latency[name] seconds (or the default
+    latency) and counted together with the bytes sent in both directions.
+    """
+
+    def __init__(self, path, engine=None, latency=None, default_latency=0.0):
+        self.path = path
+        self.engine = engine or FakeEngine()
+        self.latency = latency or {}
+        self.default_latency = default_latency
+        self.requests = collections.Counter()
+        self.bytes_in = collections.Counter()
+        self.bytes_out = collections.Counter()
+        self.routes = [(method, re.compile(r'(?:/v[0-9.]+)?%s$' % pattern), name)
+                       for method, pattern, name in ROUTES]
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        return 'unix://%s' % self.path
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        daemon = self
+
+        class Handler(_Handler):
+            fake = daemon
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_in.clear()
+            self.bytes_out.clear()
+
+    def stats(self):
+        """ Returns a copy of the request and byte counters by endpoint """
+        with self._lock:
+            return {'requests': dict(self.requests),
+                    'bytes_in': dict(self.bytes_in),
+                    'bytes_out': dict(self.bytes_out)}
+
+    def count(self, name, bytes_in=0, bytes_out=0, request=False):
+        with self._lock:
+            if request:
+                self.requests[name] += 1
+            self.bytes_in[name] += bytes_in
+            self.bytes_out[name] += bytes_out
+
+    def delay(self, name):
+        delay = self.latency.get(name, self.default_latency)
+        if delay:
+            time.sleep(delay)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def do_GET(self):
+        self._dispatch()
+
+    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        query = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        for method, pattern, name in self.fake.routes:
+            match = pattern.match(url.path)
+            if method == self.command and match:
+                break
+        else:
+            self._reply('unknown', 404, {'message': 'page not found'})
+            return
+
+        self.fake.count(name, bytes_in=len(body), request=True)
+        self.fake.delay(name)
+        args = [unquote(arg) for arg in match.groups()]
+        try:
+            getattr(self, '_' + name)(name, query, body, *args)
+        except docker.errors.NotFound as e:
+            self._reply(name, 404, {'message': str(e)})
+        except Exception as e:
+            self._reply(name, 500, {'message': repr(e)})
+
+    # endpoints
+
+    def _version(self, name, query, body):
+        self._reply(name, 200, {'Version': 'fake', 'ApiVersion': '1.41', 'MinAPIVersion': '1.12'})
+
+    def _ping(self, name, query, body):
+        self._reply(name, 200, b'OK', content_type='text/plain')
+
+    def _create_container(self, name, query, body):
+        config = json.loads(body or b'{}')
+        image = config.pop('Image')
+        config.setdefault('Tty', False)
+        self._reply(name, 201, self.fake.engine.create_container(image=image, **config))
+
+    def _start(self, name, query, body, container_id):
+        self.fake.engine.start(container_id)
+        self._reply(name, 204)
+
+    def _kill(self, name, query, body, container_id):
+        self.fake.engine.kill(container_id)
+        self._reply(name, 204)
+
+    def _remove_container(self, name, query, body, container_id):
+        self.fake.engine.remove_container(container_id)
+        self._reply(name, 204)
+
+    def _inspect_container(self, name, query, body, container_id):
+        self._reply(name, 200, self.fake.engine.inspect_container(container_id))
+
+    def _logs(self, name, query, body, container_id):
+        kwargs = {'timestamps': query.get('timestamps') in ('1', 'true', 'True')}
+        if query.get('since'):
+            kwargs['since'] = int(float(query['since']))
+
+        # the output of containers with a terminal is not multiplexed
+        frame, content_type = _frame, 'application/vnd.docker.multiplexed-stream'
+        if self.fake.engine.containers.get(container_id, {}).get('config', {}).get('Tty'):
+            frame, content_type = bytes, 'application/vnd.docker.raw-stream'
+
+        if query.get('follow') in ('1', 'true', 'True'):
+            self._start_stream(name, content_type)
+            for line in self.fake.engine.logs(container_id, stream=True, follow=True, **kwargs):
+                self._write(name, frame(line))
+            return
+
+        self._reply(name, 200, frame(self.fake.engine.logs(container_id, **kwargs)), content_type=content_type)
+
+    def _attach(self, name, query, body, container_id):
+        self._logs(name, {}, body, container_id)
+
+    def _top(self, name, query, body, container_id):
+        self._reply(name, 200, self.fake.engine.top(container_id, ps_args=query.get('ps_args')))
+
+    def _get_archive(self, name, query, body, container_id):
+        stream, stat = self.fake.engine.get_archive(container_id, query['path'])
+        header = base64.b64encode(json.dumps(stat).encode()).decode()
+        self._reply(name, 200, b''.join(stream), content_type='application/x-tar',
+                    headers={'X-Docker-Container-Path-Stat': header})
+
+    def _stat_archive(self, name, query, body, container_id):
+        stat = self.fake.engine.stat_archive(container_id, query['path'])
+        header = base64.b64encode(json.dumps(stat).encode()).decode()
+        self._reply(name, 200, b'', content_type='text/plain', headers={'X-Docker-Container-Path-Stat': header})
+
+    def _put_archive(self, name, query, body, container_id):
+        self.fake.engine.put_archive(container_id, query['path'], body)
+        self._reply(name, 200, b'', content_type='text/plain')
+
+    def _exec_create(self, name, query, body, container_id):
+        config = json.loads(body or b'{}')
+        self._reply(name, 201, self.fake.engine.exec_create(container_id, config['Cmd']))
+
+    def _exec_start(self, name, query, body, exec_id):
+        config = json.loads(body or b'{}')
+        if config.get('Detach'):
+            self.fake.engine.exec_start(exec_id, detach=True)
+            self._reply(name, 200, b'', content_type='text/plain')
+            return
+
+        # the connection is hijacked by the client, which reads the frames
+        # from the socket after the headers, so the headers go out first
+        self._start_stream(name, 'application/vnd.docker.raw-stream')
+        time.sleep(0.001)
+        for chunk in self.fake.engine.exec_start(exec_id, stream=True):
+            self._write(name, _frame(chunk))
+
+    def _exec_inspect(self, name, query, body, exec_id):
+        self._reply(name, 200, self.fake.engine.exec_inspect(exec_id))
+
+    def _inspect_image(self, name, query, body, image):
+        self._reply(name, 200, self.fake.engine.inspect_image(image))
+
+    def _history(self, name, query, body, image):
+        self._reply(name, 200, self.fake.engine.history(image))
+
+    def _tag(self, name, query, body, image):
+        self.fake.engine.tag(image, query['repo'], query.get('tag'), force=query.get('force') in ('1', 'true', 'True'))
+        self._reply(name, 201, b'', content_type='text/plain')
+
+    def _remove_image(self, name, query, body, image):
+        self.fake.engine.remove_image(image, force=query.get('force') in ('1', 'true', 'True'))
+        self._reply(name, 200, [{'Untagged': image}])
+
+    # responses
+
+    def _reply(self, name, status, payload=None, content_type='application/json', headers=None):
+        if payload is None:
+            data = b''
+        elif isinstance(payload, bytes):
+            data = payload
+        else:
+            data = json.dumps(payload).encode()
+
+        self.send_response(status)
+        if data or status != 204:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            # a HEAD response has the headers of the GET one, but no body
+            self._write(name, data)
+
+    def _start_stream(self, name, content_type):
+        """ Sends the headers of a response which lasts until the connection is closed """
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+
+    def _write(self, name, data):
+        if data:
+            self.wfile.write(data)
+            self.wfile.flush()
+            self.fake.count(name, bytes_out=len(data))
+
+
+def _frame(data, stream=1):
+    """ Wraps data in a frame of the multiplexed stdout/stderr stream """
+    if not data:
+        return b''
+    return struct.pack('>BxxxL', stream, len(data)) + data
@@ -1,19 +1,94 @@
 # -*- coding: utf-8 -*-
 # This file is automatically generated by Containers Testing Framework
 # Any changes to this file will be discarded
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "steps"))
+
+import api_tracer
+import instrumentation
+from container_pool import ContainerPool
+from container_reaper import ContainerReaper
+import s2i_cache
+import s2i_prebuild
 
 
 # Some useful functions for your environment.py
+def before_all(context):
+    # timings are recorded only with CTF_INSTRUMENTATION_DIR set
+    instrumentation.start()
+    # engine API calls are traced only with CTF_API_TRACE=1
+    api_tracer.start()
+    context.container_reaper = ContainerReaper()
+    context.container_pool = ContainerPool(discard=context.container_reaper.submit)
+    context.s2i_cache = s2i_cache.BuildCache() if s2i_cache.ENABLED else None
+    # distinct s2i builds of the run start in the background right away
+    context.s2i_prebuild = s2i_prebuild.Prebuild(context.s2i_cache)
+    context.s2i_prebuild.start(context)
+
+
 def before_scenario(context, scenario):
     context.containers = []
     context.variables = {}
+    recorder = instrumentation.recorder()
+    if recorder:
+        recorder.scenario = scenario.name
+    tracer = api_tracer.tracer()
+    if tracer:
+        tracer.scenario = scenario.name
+
+
+def before_step(context, step):
+    # cached container files are valid only within one step phase
+    if step.step_type != getattr(context, 'step_type', None):
+        context.step_type = step.step_type
+        for container in getattr(context, 'containers', []):
+            container.invalidate_snapshots()
+
+    recorder = instrumentation.recorder()
+    if recorder:
+        recorder.step = "%s %s" % (step.keyword, step.name)
+        context.step_start_time = time.time()
+    tracer = api_tracer.tracer()
+    if tracer:
+        tracer.start_step("%s %s" % (step.keyword, step.name))
+
+
+def after_step(context, step):
+    recorder = instrumentation.recorder()
+    if recorder:
+        start_time = context.step_start_time
+        recorder.record('step', step.name, start_time, time.time() - start_time,
+                        status=getattr(step.status, 'name', step.status), location=str(step.location))
+        recorder.step = None
+    tracer = api_tracer.tracer()
+    if tracer:
+        tracer.step = None
 
 
 def after_scenario(context, scenario):
     try:
         for container in context.containers:
-            container.stop()
+            if getattr(container, 'pool_key', None):
+                # a container of a failed scenario may be in any state
+                context.container_pool.release(container, reusable=scenario.status != "failed")
+            else:
+                # removed in the background, see after_all
+                context.container_reaper.submit(container)
 
         context.containers = []
     except AttributeError:
         pass
+
+
+def after_all(context):
+    try:
+        context.container_pool.shutdown()
+        context.container_reaper.shutdown()
+        context.s2i_prebuild.shutdown()
+    except AttributeError:
+        pass
+    api_tracer.stop()
+    instrumentation.stop()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Runs the scenarios in parallel: the scenarios selected by the behave
+arguments are sharded across worker processes, each running behave on its
+share of scenarios (as file:line locations), and the JSON reports of the
+workers are merged into one.
+
+    python parallel.py [-j WORKERS] [--cpus-per-worker N] [--memory LIMIT]
+                       [--work-dir DIR] [--report FILE] [BEHAVE ARGS...]
+
+Every worker gets CTF_WORKER_ID, so the images it builds, the container
+logs it saves and its timings and API trace files do not clash with the
+other workers (see steps/worker.py). With --cpus-per-worker the containers
+of every worker are pinned to their own CPUs, --memory limits the memory
+of every container. The output of every worker is written to
+worker-<ID>.log in the work directory, the exit code is 1 when any worker
+failed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from behave.configuration import Configuration
+from behave.runner_util import collect_feature_locations, parse_features
+
+# Statuses of a scenario which did not run in the worker's report
+NOT_RUN = frozenset(['skipped', 'untested', None])
+
+
+def select_scenarios(behave_args):
+    """ Returns the paths given to behave and the file:line locations of the scenarios selected to run """
+    config = Configuration(behave_args)
+    paths = config.paths or ['features']
+    features = parse_features(collect_feature_locations(paths), language=config.lang)
+
+    locations = []
+    for feature in features:
+        for scenario in feature.walk_scenarios():
+            if scenario.should_run(config):
+                locations.append("%s:%s" % (scenario.location.filename, scenario.location.line))
+    return config.paths, locations
+
+
+def shard(locations, workers):
+    """ Splits the locations round-robin, so scenarios of one feature spread across the workers """
+    shards = [locations[i::workers] for i in range(workers)]
+    return [s for s in shards if s]
+
+
+def worker_environ(worker_id, cpus_per_worker=None, memory=None):
+    environ = dict(os.environ)
+    environ['CTF_WORKER_ID'] = str(worker_id)
+    if cpus_per_worker:
+        first = (worker_id - 1) * cpus_per_worker
+        environ['CTF_WORKER_CPUSET'] = "%s-%s" % (first, first + cpus_per_worker - 1)
+    if memory:
+        environ['CTF_WORKER_MEMORY'] = memory
+    if environ.get('CTF_INSTRUMENTATION_DIR'):
+        environ['CTF_INSTRUMENTATION_DIR'] = os.path.join(environ['CTF_INSTRUMENTATION_DIR'],
+                                                          "worker-%s" % worker_id)
+    if environ.get('CTF_API_TRACE_FILE'):
+        base, ext = os.path.splitext(environ['CTF_API_TRACE_FILE'])
+        environ['CTF_API_TRACE_FILE'] = "%s.worker-%s%s" % (base, worker_id, ext)
+    return environ
+
+
+def merge_reports(reports):
+    """
+    Merges the behave JSON reports of the workers by feature. A worker
+    reports the scenarios it did not run as skipped, the result of the
+    worker which ran the scenario is kept.
+    """
+    features = {}
+    for report in reports:
+        for feature in report:
+            merged = features.setdefault(feature['location'], dict(feature, elements=[]))
+            for element in feature.get('elements', []):
+                _merge_element(merged['elements'], element)
+
+    for feature in features.values():
+        feature['elements'].sort(key=lambda element: _line(element['location']))
+        statuses = set(element.get('status') for element in feature['elements'] if element.get('type') != 'background')
+        if 'failed' in statuses:
+            feature['status'] = 'failed'
+        elif 'passed' in statuses:
+            feature['status'] = 'passed'
+        else:
+            feature['status'] = 'skipped'
+
+    return sorted(features.values(), key=lambda feature: feature['location'])
+
+
+def _merge_element(elements, element):
+    for i, existing in enumerate(elements):
+        if existing['location'] == element['location'] and existing.get('type') == element.get('type'):
+            if existing.get('status') in NOT_RUN and element.get('status') not in NOT_RUN:
+                elements[i] = element
+            return
+    elements.append(element)
+
+
+def _line(location):
+    try:
+        return int(location.rsplit(':', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _has_format(behave_args):
+    return any(arg in ('-f', '--format') or arg.startswith('--format=') or
+               (arg.startswith('-f') and not arg.startswith('--')) for arg in behave_args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the behave scenarios in parallel worker processes",
+                                     epilog="The other arguments are passed to behave.")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument('--cpus-per-worker', type=int, help="pin the containers of every worker to this many CPUs")
+    parser.add_argument('--memory', help="memory limit of every container, e.g. 2g")
+    parser.add_argument('--work-dir', default="parallel", help="directory for the logs and reports of the workers")
+    parser.add_argument('--report', default="report.json", help="file the merged JSON report is written to")
+    args, behave_args = parser.parse_known_args()
+
+    paths, locations = select_scenarios(behave_args)
+    if not locations:
+        print("No scenarios selected")
+        return 0
+
+    # the workers get their scenarios as locations instead of the paths
+    behave_args = [arg for arg in behave_args if arg not in paths]
+    if not os.path.exists(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    workers = []
+    for worker_id, share in enumerate(shard(locations, max(args.workers, 1)), 1):
+        report = os.path.join(args.work_dir, "worker-%s.json" % worker_id)
+        log_path = os.path.join(args.work_dir, "worker-%s.log" % worker_id)
+        # the report comes first, the formats of behave_args then go to the log
+        command = [sys.executable, '-m', 'behave', '-f', 'json', '-o', report] + behave_args
+        if not _has_format(behave_args):
+            command += ['-f', 'plain']
+        command += share
+
+        log = open(log_path, 'w')
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT,
+                                   env=worker_environ(worker_id, args.cpus_per_worker, args.memory))
+        workers.append((worker_id, process, log, report, log_path))
+        print("Worker %s runs %s scenarios, its output goes to %s" % (worker_id, len(share), log_path))
+
+    reports = []
+    failed = False
+    for worker_id, process, log, report, log_path in workers:
+        exit_code = process.wait()
+        log.close()
+        if exit_code:
+            failed = True
+            print("Worker %s failed with exit code %s, see %s" % (worker_id, exit_code, log_path))
+        try:
+            with open(report) as f:
+                reports.append(json.load(f))
+        except (IOError, ValueError) as e:
+            failed = True
+            print("Worker %s did not write its report: %s" % (worker_id, e))
+
+    merged = merge_reports(reports)
+    with open(args.report, 'w') as f:
+        json.dump(merged, f, indent=2)
+
+    statuses = [element.get('status') for feature in merged for element in feature['elements']
+                if element.get('type') != 'background']
+    print("%s scenarios passed, %s failed, %s skipped, the report is in %s" % (
+        statuses.count('passed'), statuses.count('failed'),
+        len([s for s in statuses if s in NOT_RUN]), args.report))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
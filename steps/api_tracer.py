@@ -0,0 +1,170 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from engine import LOCAL_CALLS, wrap_client
+
+# Traces the container engine API calls when set to 1
+ENABLED = os.environ.get('CTF_API_TRACE') == '1'
+
+# Identical inspect calls closer than this many milliseconds are redundant
+WINDOW = float(os.environ.get('CTF_API_TRACE_WINDOW', 100))
+
+# File the summary is written to as JSON, besides logging it
+SUMMARY_FILE = os.environ.get('CTF_API_TRACE_FILE')
+
+# Number of examples kept for every redundant call pattern
+MAX_EXAMPLES = 5
+
+_tracer = None
+
+
+class ApiTracer(object):
+    """
+    Counts the engine API calls per scenario and per step and detects the
+    redundant ones: inspects repeated with the same arguments within the
+    window and log fetches returning nothing new.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.window = window / 1000.0
+        self.scenario = None
+        self.step = None
+        self.calls = collections.Counter()
+        self.by_scenario = collections.defaultdict(collections.Counter)
+        self.by_step = collections.defaultdict(collections.Counter)
+        self.step_runs = collections.Counter()
+        self.redundant = collections.Counter()
+        self.examples = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.logging = logging.getLogger("dock.middleware.tracer")
+        self._inspected = {}
+        self._fetched = {}
+
+    def start_step(self, name):
+        with self.lock:
+            self.step = name
+            self.step_runs[name] += 1
+
+    def called(self, name, args, kwargs, started, result):
+        """ Counts a finished call and checks whether it was redundant """
+        with self.lock:
+            self.calls[name] += 1
+            self.by_scenario[self.scenario][name] += 1
+            if self.step:
+                self.by_step[self.step][name] += 1
+
+            if 'inspect' in name:
+                key = (name, repr(args), repr(sorted(kwargs.items())))
+                previous = self._inspected.get(key)
+                self._inspected[key] = started
+                if previous is not None and started - previous < self.window:
+                    self._redundant("%s repeated within %d ms" % (name, self.window * 1000),
+                                    "%s%s %.1f ms after the same call" % (
+                                        name, _describe(args, kwargs), (started - previous) * 1000))
+
+            if name in ('logs', 'attach') and isinstance(result, bytes):
+                key = (name, repr(kwargs.get('container', args[:1])))
+                digest = hashlib.sha1(result).hexdigest()
+                if self._fetched.get(key) == digest or (not result and kwargs.get('since')):
+                    self._redundant("%s without new data" % name,
+                                    "%s%s returned %s bytes seen before" % (
+                                        name, _describe(args, kwargs), len(result)))
+                self._fetched[key] = digest
+
+    def _redundant(self, pattern, description):
+        self.redundant[pattern] += 1
+        examples = self.examples[pattern]
+        if len(examples) < MAX_EXAMPLES:
+            examples.append({'scenario': self.scenario, 'step': self.step, 'call': description})
+
+    def summary(self):
+        with self.lock:
+            steps = []
+            for step, calls in self.by_step.items():
+                runs = max(self.step_runs[step], 1)
+                steps.append({'step': step, 'runs': runs, 'calls': dict(calls),
+                              'calls_per_run': sum(calls.values()) / float(runs)})
+            steps.sort(key=lambda s: -s['calls_per_run'])
+
+            return {
+                'calls': dict(self.calls),
+                'scenarios': dict((str(scenario), dict(calls)) for scenario, calls in self.by_scenario.items()),
+                'steps': steps,
+                'redundant': dict(self.redundant),
+                'examples': dict(self.examples),
+            }
+
+    def report(self, path=SUMMARY_FILE):
+        """ Logs the summary and writes it to path as JSON """
+        summary = self.summary()
+
+        self.logging.info("%s engine API calls: %s" % (sum(summary['calls'].values()), ", ".join(
+            "%s=%s" % call for call in sorted(summary['calls'].items(), key=lambda c: -c[1]))))
+        for step in summary['steps'][:10]:
+            self.logging.info("%.1f calls per run (%s runs) of step '%s'" % (
+                step['calls_per_run'], step['runs'], step['step']))
+        for pattern, count in sorted(summary['redundant'].items(), key=lambda r: -r[1]):
+            self.logging.warning("%s redundant calls: %s" % (count, pattern))
+            for example in summary['examples'][pattern]:
+                self.logging.warning("  %s (scenario '%s', step '%s')" % (
+                    example['call'], example['scenario'], example['step']))
+
+        if path:
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+        return summary
+
+
+class TracingClient(object):
+    """ Wraps the engine client and reports every call to the tracer """
+
+    def __init__(self, client, tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name in LOCAL_CALLS:
+            return attribute
+
+        def call(*args, **kwargs):
+            started = time.time()
+            result = None
+            try:
+                result = attribute(*args, **kwargs)
+                return result
+            finally:
+                self._tracer.called(name, args, kwargs, started, result)
+        return call
+
+
+def start(enabled=ENABLED):
+    """ Starts tracing when enabled, returns the tracer or None """
+    global _tracer
+
+    if enabled and _tracer is None:
+        _tracer = ApiTracer()
+        wrap_client(lambda client: TracingClient(client, _tracer))
+    return _tracer
+
+
+def tracer():
+    return _tracer
+
+
+def stop():
+    global _tracer
+
+    if _tracer:
+        _tracer.report()
+        _tracer = None
+
+
+def _describe(args, kwargs):
+    arguments = [repr(arg) for arg in args] + ["%s=%r" % item for item in sorted(kwargs.items())]
+    return "(%s)" % ", ".join(arguments)
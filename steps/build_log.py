@@ -0,0 +1,106 @@
+import codecs
+import os
+import re
+import tempfile
+
+# Build logs bigger than this are kept in a temporary file instead of memory
+SPILL_SIZE = int(os.environ.get('CTF_BUILD_LOG_SPILL_SIZE', 8 * 1024 * 1024))
+
+# The end of the log always kept in memory, e.g. for error messages
+TAIL_SIZE = int(os.environ.get('CTF_BUILD_LOG_TAIL_SIZE', 64 * 1024))
+
+# Size of the chunks the log is scanned in
+CHUNK_SIZE = 1024 * 1024
+
+# Characters of the previous chunk scanned again by search(), so that
+# matches spanning lines across the chunk boundary are found as well
+SEARCH_OVERLAP = 64 * 1024
+
+
+class BuildLog(object):
+    """
+    Output of a command which may be too big to keep in memory. It is
+    written to a SpooledTemporaryFile which moves to disk above spill_size
+    bytes, the last tail_size bytes are kept in memory. The log is scanned
+    in chunks by contains() (also used by 'in') and search().
+    """
+
+    def __init__(self, spill_size=SPILL_SIZE, tail_size=TAIL_SIZE):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spill_size)
+        self.size = 0
+        self.tail_size = tail_size
+        self._tail = bytearray()
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self._tail.extend(data)
+        if len(self._tail) > self.tail_size:
+            del self._tail[:len(self._tail) - self.tail_size]
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """ Yields the log from the start in chunks of bytes """
+        position = 0
+        while position < self.size:
+            self.file.seek(position)
+            chunk = self.file.read(min(chunk_size, self.size - position))
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+        self.file.seek(0, os.SEEK_END)
+
+    def contains(self, phrase):
+        needle = phrase.encode('utf-8')
+        carry = b''
+        for chunk in self.chunks():
+            data = carry + chunk
+            if needle in data:
+                return True
+            carry = data[len(data) - len(needle) + 1:] if len(needle) > 1 else b''
+        return False
+
+    def search(self, regex, flags=re.MULTILINE):
+        """
+        Returns the first match of the regex or None, it is searched for in
+        complete lines so ^ and $ work as they do on the whole log
+        """
+        pattern = re.compile(regex, flags)
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        carry = ''
+
+        for chunk in self.chunks():
+            text = carry + decoder.decode(chunk)
+            end = text.rfind('\n') + 1
+            if not end:
+                carry = text
+                continue
+
+            match = pattern.search(text, 0, end)
+            if match:
+                return match
+            carry = text[text.rfind('\n', 0, max(end - SEARCH_OVERLAP, 0)) + 1:]
+
+        return pattern.search(carry + decoder.decode(b'', True))
+
+    def tail(self):
+        """ Returns the end of the log (up to tail_size bytes) as text """
+        return self._tail.decode('utf-8', 'replace')
+
+    def close(self):
+        self.file.close()
+
+    def __contains__(self, phrase):
+        return self.contains(phrase)
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        # an empty log of a successful command is still a result
+        return True
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return b''.join(self.chunks()).decode('utf-8', 'replace')
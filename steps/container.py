@@ -22,20 +22,57 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.mgb
 """
 from __future__ import print_function
+import calendar
+import collections
 import docker
-import podman
+import http.cookiejar
+import io
 import json
 import logging
 import os
+import posixpath
+import random
 import re
+import requests
 import tarfile
 import tempfile
+import threading
 import time
 
-try:
-    d = docker.Client(version="1.22")
-except:
-    d = docker.APIClient(version="1.22")
+from engine import client, host_config_args
+from instrumentation import timed
+import worker
+
+# Prefix added to every log line when logs are requested with timestamps,
+# e.g. '2019-05-13T10:21:32.104738925Z '
+LOG_TIMESTAMP = re.compile(br'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,9}))?Z ')
+
+# Seconds between log polls when the log cannot be followed
+LOG_POLL_INTERVAL = float(os.environ.get('CTF_LOG_POLL_INTERVAL', 1))
+
+# Delay before the first retry of a failed container removal, it doubles
+# with every further try up to REMOVE_RETRY_MAX_DELAY
+REMOVE_RETRY_DELAY = float(os.environ.get('CTF_REMOVE_RETRY_DELAY', 1))
+REMOVE_RETRY_MAX_DELAY = float(os.environ.get('CTF_REMOVE_RETRY_MAX_DELAY', 20))
+
+# How long to wait for the exit code of a command after its output ended
+EXEC_EXIT_TIMEOUT = float(os.environ.get('CTF_EXEC_EXIT_TIMEOUT', 15))
+
+# Maximum number of kept-alive HTTP connections per container
+HTTP_POOL_SIZE = int(os.environ.get('CTF_HTTP_POOL_SIZE', 10))
+
+# Single files up to this size are fetched (and cached) together with their stat
+SNAPSHOT_MAX_FILE_SIZE = int(os.environ.get('CTF_SNAPSHOT_MAX_FILE_SIZE', 10 * 1024 * 1024))
+
+# Go os.FileMode bits returned by the archive API in the path stat
+MODE_DIR = 1 << 31
+MODE_SYMLINK = 1 << 27
+# devices, named pipes, sockets and irregular files
+MODE_OTHER = (1 << 26) | (1 << 25) | (1 << 24) | (1 << 21) | (1 << 19)
+
+# type is one of 'file', 'directory', 'symlink' or 'other', link is the
+# target of a symlink
+PathStat = collections.namedtuple('PathStat', ['type', 'size', 'link'])
 
 
 class ExecException(Exception):
@@ -44,24 +81,205 @@ class ExecException(Exception):
         self.output = output
 
 
+def create_http_session(pool_size=HTTP_POOL_SIZE):
+    """
+    Returns a requests Session keeping up to pool_size connections alive per
+    host. It only reuses connections, cookies are rejected so that a request
+    does not change the result of the later ones.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def http_session_stats(session):
+    """ Returns a (requests, connections) tuple, the number of requests sent and connections opened """
+    sent = opened = 0
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            sent += pool.num_requests
+            opened += pool.num_connections
+    return sent, opened
+
+
+class SnapshotMiss(Exception):
+    """ The cached filesystem snapshot cannot answer a question about a path """
+
+
+class FileSnapshot(object):
+    """
+    A subtree of the container filesystem fetched with the archive API. The
+    tar stream is spilled to a temporary file, only the index of its entries
+    is kept in memory and file contents are read on demand.
+    """
+
+    def __init__(self, root, stream):
+        self.root = posixpath.normpath(root)
+        self.file = tempfile.TemporaryFile()
+        for chunk in stream:
+            self.file.write(chunk)
+        self.file.seek(0)
+        self.tar = tarfile.open(fileobj=self.file)
+        self.entries = {}
+
+        parent = posixpath.dirname(self.root)
+        for member in self.tar.getmembers():
+            self.entries[posixpath.normpath(posixpath.join(parent, member.name))] = member
+
+    def covers(self, path):
+        return path == self.root or path.startswith(self.root.rstrip('/') + '/')
+
+    def stat(self, path):
+        """ Returns the PathStat of a covered path, None if it does not exist """
+        member = self.entries.get(path)
+        if member is None:
+            return None
+        if member.issym():
+            return PathStat('symlink', 0, posixpath.normpath(posixpath.join(posixpath.dirname(path), member.linkname)))
+        if member.isdir():
+            return PathStat('directory', 0, None)
+        if member.isfile():
+            return PathStat('file', member.size, None)
+        return PathStat('other', 0, None)
+
+    def parent_link(self, path):
+        """
+        Returns (link, target) of the first symlink among the parents of a
+        covered path, None if there is none. The entries under a symlinked
+        directory are not in the snapshot, a symlink root is archived as the
+        link itself.
+        """
+        relative = posixpath.relpath(path, self.root)
+        if relative == '.':
+            return None
+        parent = self.root
+        for name in [''] + relative.split('/')[:-1]:
+            parent = posixpath.join(parent, name) if name else parent
+            member = self.entries.get(parent)
+            if member is not None and member.issym():
+                return parent, posixpath.normpath(posixpath.join(posixpath.dirname(parent), member.linkname))
+        return None
+
+    def read(self, path):
+        return self.tar.extractfile(self.entries[path]).read()
+
+    def close(self):
+        self.tar.close()
+        self.file.close()
+
+
+class ExecStream(object):
+    """
+    Output of a command running in the container, read as it is produced.
+    Iterating yields output chunks, or (stdout, stderr) tuples with demux.
+    close() stops reading early, a command which keeps writing is then
+    terminated by a broken pipe.
+    """
+
+    def __init__(self, exec_id, stream, cmd):
+        self.exec_id = exec_id
+        self.stream = stream
+        self.cmd = cmd
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
+
+    def exit_code(self, timeout=EXEC_EXIT_TIMEOUT):
+        """
+        Returns the exit code of the command, it is usually known as soon
+        as the output ended, otherwise it's polled with a growing delay.
+        Raises ExecException when the command still runs after timeout seconds.
+        """
+        deadline = time.time() + timeout
+        delay = 0.01
+
+        while True:
+            retcode = client().exec_inspect(self.exec_id)['ExitCode']
+            if retcode is not None:
+                return retcode
+            if time.time() > deadline:
+                raise ExecException("Command %s timed out" % self.cmd)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+
+class LogCursor(object):
+    """
+    Position of a reader in the log of a container. Every read() returns only
+    the output appended since the previous read, prefixed with up to `overlap`
+    bytes of already returned output so that matches crossing the boundary
+    between two reads are found as well.
+    """
+
+    def __init__(self, container, overlap=0, align_lines=False):
+        self.container = container
+        self.overlap = overlap
+        self.align_lines = align_lines
+        self.offset = container.log_origin
+
+    def read(self):
+        """ Returns a (data, start) tuple, start is the offset of data in the log """
+        self.container.fetch_new_output()
+        data, start = self.container.read_log(max(0, self.offset - self.overlap), self.align_lines)
+        self.offset = start + len(data)
+        return data, start
+
+    def wait(self, timeout):
+        """ Waits at most timeout seconds for output which was not read yet """
+        self.container.wait_for_output(self.offset, timeout)
+
+
 class Container(object):
     """
     Object representing a docker test container, it is used in tests
     """
 
-    def __init__(self, image_id, name=None, remove_image=False, output_dir="output", save_output=True, volumes=None, **kwargs):
+    def __init__(self, image_id, name=None, remove_image=False, output_dir=None, save_output=True, volumes=None, **kwargs):
         self.image_id = image_id
         self.container = None
         self.name = name
         self.ip_address = None
-        self.output_dir = output_dir
+        self.output_dir = output_dir or worker.output_dir()
         self.save_output = save_output
         self.remove_image = remove_image
         self.kwargs = kwargs
         self.logging = logging.getLogger("dock.middleware.container")
         self.running = False
+        self.started_at = None
+        # seconds after the start when ports accepted connections
+        self.port_open_times = {}
+        # seconds after the start when processes appeared
+        self.process_start_times = {}
         self.volumes = volumes
         self.environ = {}
+        # local copy of the container log, see fetch_new_output()
+        self._log = bytearray()
+        # parsed XML documents by path, see xml_steps.parse_document()
+        self.documents = {}
+        self._log_since = None
+        self._log_since_count = 0
+        # lines stamped _log_since still to be skipped in the current fetch or stream
+        self._log_replay = 0
+        self._log_by_offset = False
+        self.log_origin = 0
+        self._log_keep = True
+        self._log_pending = b''
+        self._log_condition = threading.Condition()
+        self._log_stream = None
+        self._log_follower = None
+        self._http_session = None
+        # filesystem snapshots, see file_stat()
+        self._snapshots = []
+        self._path_stats = {}
 
         # get volumes from env (CTF_DOCKER_VOLUME=out:in:z,out2:in2:z)
         try:
@@ -90,16 +308,20 @@ class Container(object):
 
     def start(self, **kwargs):
         """ Starts a detached container for selected image """
-        self._create_container(**kwargs)
+        self.invalidate_snapshots()
+        with timed('lifecycle', 'create', image=self.image_id):
+            self._create_container(**kwargs)
         self.logging.debug("Starting container '%s'..." % self.container.get('Id'))
-        d.start(container=self.container)
+        with timed('lifecycle', 'start', container=self.container.get('Id')):
+            client().start(container=self.container)
         self.running = True
+        self.started_at = time.time()
         self.ip_address = self.inspect()['NetworkSettings']['IPAddress']
 
     def _remove_container(self, number=1):
         self.logging.info("Removing container '%s', %s try..." % (self.container['Id'], number))
         try:
-            d.remove_container(self.container)
+            client().remove_container(self.container)
             self.logging.info("Container '%s' removed", self.container['Id'])
         except:
             self.logging.info("Removing container '%s' failed" % self.container['Id'])
@@ -107,8 +329,10 @@ class Container(object):
             if number > 3:
                 raise
 
-            # Give 20 more seconds for the devices to cool down
-            time.sleep(20)
+            # Give the devices some time to cool down, with jitter so that
+            # containers removed in parallel do not retry all at once
+            delay = min(REMOVE_RETRY_DELAY * 2 ** (number - 1), REMOVE_RETRY_MAX_DELAY)
+            time.sleep(random.uniform(delay / 2, delay))
             self._remove_container(number + 1)
 
     def stop(self):
@@ -127,67 +351,271 @@ class Container(object):
             if not os.path.exists(self.output_dir):
                 os.makedirs(self.output_dir)
             with open(out_path, 'w') as f:
-                print(d.logs(container=self.container.get('Id'), stream=False), file=f)
+                print(client().logs(container=self.container.get('Id'), stream=False), file=f)
 
         if self.container:
             self.logging.debug("Removing container '%s'" % self.container['Id'])
             # Kill only running container
-            if self.inspect()['State']['Running']:
-                d.kill(container=self.container)
+            with timed('lifecycle', 'stop', container=self.container.get('Id')):
+                if self.inspect()['State']['Running']:
+                    client().kill(container=self.container)
             self.running = False
-            self._remove_container()
+            self.invalidate_snapshots()
+            self.close_http_session()
+            self._stop_following_output()
+            with timed('lifecycle', 'remove', container=self.container.get('Id')):
+                self._remove_container()
             self.container = None
 
 
     def startWithCommand(self, **kwargs):
         """ Starts a detached container for selected image with a custom command"""
-        self._create_container(tty=True, **kwargs)
+        self.invalidate_snapshots()
+        with timed('lifecycle', 'create', image=self.image_id):
+            self._create_container(tty=True, **kwargs)
         self.logging.debug("Starting container '%s'..." % self.container.get('Id'))
-        d.start(self.container)
+        with timed('lifecycle', 'start', container=self.container.get('Id')):
+            client().start(self.container)
         self.running = True
+        self.started_at = time.time()
         self.ip_address = self.inspect()['NetworkSettings']['IPAddress']
 
 
     def execute(self, cmd, detach=False):
         """ executes cmd in container and return its output """
-        inst = d.exec_create(container=self.container, cmd=cmd)
-
         if (detach):
-            d.exec_start(inst, detach)
+            # the command may change any file
+            self.invalidate_snapshots()
+            inst = client().exec_create(container=self.container, cmd=cmd)
+            client().exec_start(inst, detach)
             return None
 
-        output = d.exec_start(inst, detach=detach)
-        retcode = d.exec_inspect(inst)['ExitCode']
+        stream = self.execute_stream(cmd)
+        output = b"".join(stream)
 
-        count = 0
-
-        while retcode is None:
-            count += 1
-            retcode = d.exec_inspect(inst)['ExitCode']
-            time.sleep(1)
-            if count > 15:
-                raise ExecException("Command %s timed out, output: %s" % (cmd, output))
+        try:
+            retcode = stream.exit_code()
+        except ExecException:
+            raise ExecException("Command %s timed out, output: %s" % (cmd, output))
 
-        if retcode is not 0:
+        if retcode != 0:
             raise ExecException("Command %s failed to execute, return code: %s" % (cmd, retcode), output)
 
         return output
 
+    def execute_stream(self, cmd, demux=False):
+        """ Starts cmd in the container and returns an ExecStream with its output """
+        # the command may change any file
+        self.invalidate_snapshots()
+        inst = client().exec_create(container=self.container, cmd=cmd)
+        if demux:
+            stream = client().exec_start(inst, stream=True, demux=True)
+        else:
+            stream = client().exec_start(inst, stream=True)
+        return ExecStream(inst, stream, cmd)
+
     def inspect(self):
         if self.container:
-            return d.inspect_container(container=self.container.get('Id'))
+            return client().inspect_container(container=self.container.get('Id'))
+
+    def processes(self):
+        """
+        Returns the short command names (comm) of the processes running in
+        the container, the names 'ps -C' matches, as listed by the top API
+        """
+        top = client().top(self.container.get('Id'), ps_args='-eo pid,comm')
+        titles = top.get('Titles') or []
+        column = titles.index('COMMAND') if 'COMMAND' in titles else len(titles) - 1
+        return [process[column].strip() for process in top.get('Processes') or []]
 
     def get_output(self, history=True):
+        self.fetch_new_output()
+        return bytes(self._log)
+
+    def _get_full_output(self, history=True):
         try:
-            return d.logs(container=self.container)
+            return client().logs(container=self.container)
         except:
-            return d.attach(container=self.container, stream=False, logs=history)
+            return client().attach(container=self.container, stream=False, logs=history)
+
+    def fetch_new_output(self):
+        """
+        Fetches the log output produced since the previous call and appends it
+        to the local copy of the container log. Only lines newer than the last
+        seen timestamp are transferred. Returns the number of new bytes.
+        When the log is followed the copy is kept current by the follower
+        thread and nothing is fetched.
+        """
+        with self._log_condition:
+            size = len(self._log)
+
+            if self._log_follower:
+                return 0
+
+            if not self._log_by_offset:
+                kwargs = {'timestamps': True}
+                if self._log_since:
+                    # 'since' has a one second resolution, older lines are skipped below
+                    kwargs['since'] = self._log_since[0]
+                self._log_replay = self._log_since_count
+                try:
+                    self._append_log_lines(client().logs(container=self.container.get('Id'), **kwargs))
+                    return len(self._log) - size
+                except Exception as e:
+                    self.logging.debug("Cannot fetch logs incrementally, using byte offsets: %s" % e)
+                    self._log_by_offset = True
+                    del self._log[:]
+
+            self._log.extend(self._get_full_output()[len(self._log):])
+            return len(self._log) - size
+
+    def follow_output(self):
+        """
+        Starts a thread which follows the container log and appends new output
+        to the local copy as soon as it is printed, waking up everybody waiting
+        in wait_for_output(). Returns False if the log cannot be followed,
+        callers then have to poll with fetch_new_output().
+        """
+        with self._log_condition:
+            if self._log_follower:
+                return True
+
+        self.fetch_new_output()
+
+        with self._log_condition:
+            if self._log_by_offset or not self.running:
+                return False
+
+            kwargs = {'timestamps': True, 'stream': True, 'follow': True}
+            if self._log_since:
+                kwargs['since'] = self._log_since[0]
+            self._log_replay = self._log_since_count
+            try:
+                self._log_stream = client().logs(container=self.container.get('Id'), **kwargs)
+            except Exception as e:
+                self.logging.debug("Cannot follow logs of container '%s': %s" % (self.container.get('Id'), e))
+                return False
+
+            self._log_follower = threading.Thread(target=self._follow_output, args=(self._log_stream,),
+                                                  name="logs-%s" % self.container.get('Id')[:12])
+            self._log_follower.daemon = True
+            self._log_follower.start()
+            return True
+
+    def _follow_output(self, stream):
+        try:
+            for chunk in stream:
+                with self._log_condition:
+                    data = self._log_pending + chunk
+                    cut = data.rfind(b'\n') + 1
+                    self._log_pending = data[cut:]
+                    # an unterminated line is appended as soon as its timestamp
+                    # arrived, the rest of it comes as a continuation
+                    if LOG_TIMESTAMP.match(self._log_pending):
+                        cut = len(data)
+                        self._log_pending = b''
+                    self._append_log_lines(data[:cut])
+                    self._log_condition.notify_all()
+        except Exception as e:
+            self.logging.debug("Following logs of container '%s' ended: %s" % (self.container.get('Id'), e))
+        finally:
+            with self._log_condition:
+                self._append_log_lines(self._log_pending)
+                self._log_pending = b''
+                self._log_follower = None
+                self._log_stream = None
+                self._log_condition.notify_all()
+
+    def _stop_following_output(self):
+        with self._log_condition:
+            follower = self._log_follower
+            if self._log_stream is not None and hasattr(self._log_stream, 'close'):
+                try:
+                    self._log_stream.close()
+                except Exception:
+                    pass
+
+        if follower:
+            follower.join(5)
+
+    def wait_for_output(self, size, timeout):
+        """
+        Waits at most timeout seconds until the log grows over size bytes.
+        Without a follower thread it just sleeps for one poll interval.
+        """
+        with self._log_condition:
+            if self._log_follower:
+                deadline = time.time() + timeout
+                while len(self._log) <= size and self._log_follower:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._log_condition.wait(remaining)
+                return
+
+        time.sleep(max(min(LOG_POLL_INTERVAL, timeout), 0))
+
+    def _append_log_lines(self, data):
+        """
+        Appends timestamped log lines which were not seen yet. A fetch or
+        stream starting at the second of the last seen line replays the lines
+        seen before, the first _log_since_count lines stamped as the last one
+        are skipped, later lines with the same stamp are new.
+        """
+        keep = self._log_keep
+
+        for line in io.BytesIO(data):
+            match = LOG_TIMESTAMP.match(line)
+
+            if not match:
+                # continuation of a line longer than the log driver buffer
+                if keep:
+                    self._log.extend(line)
+                continue
+
+            stamp = (calendar.timegm(time.strptime(match.group(1).decode(), "%Y-%m-%dT%H:%M:%S")),
+                     int((match.group(2) or b'0').ljust(9, b'0')))
+
+            if self._log_since is None or stamp > self._log_since:
+                self._log_since = stamp
+                self._log_since_count = 1
+                self._log_replay = 0
+            elif stamp == self._log_since and not self._log_replay:
+                self._log_since_count += 1
+            else:
+                if stamp == self._log_since:
+                    self._log_replay -= 1
+                keep = self._log_keep = False
+                continue
+
+            keep = self._log_keep = True
+            self._log.extend(line[match.end():])
+
+    def read_log(self, start=0, align_lines=False):
+        """
+        Returns a (data, start) tuple with the locally cached log from the
+        given offset on. With align_lines the start is moved back to the
+        beginning of the line it falls into. Output before log_origin is
+        never returned.
+        """
+        with self._log_condition:
+            start = max(start, self.log_origin)
+            if align_lines:
+                start = max(self._log.rfind(b'\n', 0, start) + 1, self.log_origin)
+            return bytes(self._log[start:]), start
+
+    def mark_log(self):
+        """ Hides the output printed so far from log readers created later """
+        self.fetch_new_output()
+        with self._log_condition:
+            self.log_origin = len(self._log)
 
     def remove_image(self, force=False):
         self.logging.info("Removing image %s" % self.image_id)
-        d.remove_image(image=self.image_id, force=force)
+        client().remove_image(image=self.image_id, force=force)
 
     def copy_file_to_container(self, src_file, dest_folder):
+        self.invalidate_snapshots()
         if not os.path.isabs(src_file):
             src_file = os.path.abspath(os.path.join(os.getcwd(), src_file))
 
@@ -198,11 +626,142 @@ class Container(object):
 
             f.seek(0)
 
-            d.put_archive(
+            client().put_archive(
                 container=self.container['Id'],
                 path=dest_folder,
                 data=f.read())
 
+    def http_session(self):
+        """ Returns the HTTP session used to talk to the container, connections are reused """
+        if self._http_session is None:
+            self._http_session = create_http_session()
+        return self._http_session
+
+    def close_http_session(self):
+        if self._http_session is None:
+            return
+        sent, opened = http_session_stats(self._http_session)
+        self.logging.info("Sent %s HTTP requests to container '%s' over %s connections" % (
+            sent, self.container.get('Id'), opened))
+        self._http_session.close()
+        self._http_session = None
+
+    def snapshot(self, path):
+        """
+        Fetches the subtree under path with the archive API, later file
+        checks under it are answered locally until the snapshot is invalidated
+        """
+        path = posixpath.normpath(path)
+        self.logging.debug("Fetching a snapshot of '%s'..." % path)
+        stream, _ = client().get_archive(self.container.get('Id'), path)
+        snapshot = FileSnapshot(path, stream)
+        self._snapshots.append(snapshot)
+        return snapshot
+
+    def invalidate_snapshots(self):
+        """ Drops all cached files, called whenever the files may have changed """
+        for snapshot in self._snapshots:
+            snapshot.close()
+        self._snapshots = []
+        self._path_stats = {}
+
+    def file_stat(self, path, follow_symlinks=False):
+        """
+        Returns the PathStat of the path or None if it does not exist.
+        Paths under a snapshot are answered locally, other paths are stat-ed
+        with a HEAD archive request (small regular files are fetched right
+        away) and cached if they exist. Raises SnapshotMiss for relative paths, symlink
+        loops and engines which do not return the stat.
+        """
+        if not posixpath.isabs(path):
+            raise SnapshotMiss(path)
+        path = posixpath.normpath(path)
+
+        for _ in range(8):
+            stat = self._lookup(path)
+            if stat is None or stat.type != 'symlink' or not follow_symlinks:
+                return stat
+            path = stat.link
+
+        raise SnapshotMiss(path)
+
+    def read_file(self, path):
+        """
+        Returns the content of the file, from the snapshot if possible. The
+        archive API reads files as root, unlike 'cat' run as the container
+        user, so a file the user cannot read is still returned.
+        """
+        try:
+            stat = self.file_stat(path, follow_symlinks=True)
+        except SnapshotMiss:
+            return self.execute(cmd="cat %s" % path)
+
+        if stat is None:
+            raise ExecException("File %s does not exist" % path)
+        if stat.type == 'directory':
+            raise ExecException("File %s is a directory" % path)
+
+        path = self._real_path(posixpath.normpath(path))
+        while True:
+            link = self._lookup(path)
+            if link.type != 'symlink':
+                break
+            path = self._real_path(link.link)
+
+        for snapshot in reversed(self._snapshots):
+            if snapshot.covers(path):
+                return snapshot.read(path)
+
+        return self.snapshot(path).read(path)
+
+    def _real_path(self, path):
+        """ Resolves the symlinked parents of a path which a snapshot covers """
+        for _ in range(8):
+            link = None
+            for snapshot in reversed(self._snapshots):
+                if snapshot.covers(path):
+                    link = snapshot.parent_link(path)
+                    break
+            if link is None:
+                return path
+            path = posixpath.normpath(posixpath.join(link[1], posixpath.relpath(path, link[0])))
+
+        raise SnapshotMiss(path)
+
+    def _lookup(self, path):
+        path = self._real_path(path)
+        for snapshot in reversed(self._snapshots):
+            if snapshot.covers(path):
+                return snapshot.stat(path)
+
+        if path in self._path_stats:
+            return self._path_stats[path]
+
+        try:
+            stat = client().stat_archive(self.container.get('Id'), path)
+        except docker.errors.NotFound:
+            # not cached, the container may still create the path
+            return None
+        if stat is None:
+            # the engine did not send the stat header
+            raise SnapshotMiss(path)
+
+        mode = stat['mode']
+        if mode & MODE_DIR:
+            result = PathStat('directory', 0, None)
+        elif mode & MODE_SYMLINK:
+            result = PathStat('symlink', 0, posixpath.normpath(stat['linkTarget']))
+        elif mode & MODE_OTHER:
+            result = PathStat('other', 0, None)
+        elif stat['size'] <= SNAPSHOT_MAX_FILE_SIZE:
+            # a small regular file, keep its content as well
+            return self.snapshot(path).stat(path)
+        else:
+            result = PathStat('file', stat['size'], None)
+
+        self._path_stats[path] = result
+        return result
+
     def _create_container(self, **kwargs):
         """ Creates a detached container for selected image """
         if self.running:
@@ -234,22 +793,24 @@ class Container(object):
 
         self.logging.debug("Creating container from image '%s'..." % self.image_id)
 
-        # we need to split kwargs to the args with belongs to create_host_config and
-        # create_container - be aware - this moved to differnet place for new docker
-        # python API
-        host_c_args_names = docker.utils.utils.create_host_config.__code__.co_varnames
-        host_c_args_names = list(host_c_args_names) + ['cpu_quota', 'cpu_period', 'mem_limit']
-        for arg in host_c_args_names:
-            if arg in kwargs:
-                host_args[arg] = kwargs.pop(arg)
-                try:
-                    host_args[arg] = int(host_args[arg])
-                except:
-                    pass
+        # parallel workers may be pinned to their own CPUs and memory
+        worker.resource_limits(kwargs)
 
-        self.container = d.create_container(image=self.image_id,
-                                            detach=True,
-                                            volumes=volume_mount_points,
-                                            host_config=d.create_host_config(**host_args),
-                                            **kwargs)
+        # we need to split kwargs to the args with belongs to create_host_config and
+        # create_container
+        for arg in host_config_args().intersection(kwargs):
+            host_args[arg] = kwargs.pop(arg)
+            if arg == 'cpuset_cpus':
+                # a cpuset like 2 or 0-3 is passed as a string
+                continue
+            try:
+                host_args[arg] = int(host_args[arg])
+            except:
+                pass
+
+        self.container = client().create_container(image=self.image_id,
+                                                   detach=True,
+                                                   volumes=volume_mount_points,
+                                                   host_config=client().create_host_config(**host_args),
+                                                   **kwargs)
 
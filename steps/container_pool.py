@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+
+
+class ContainerPool(object):
+    """
+    Keeps running containers so that scenarios tagged with @reuse_container
+    can share them instead of starting a new container every time.
+
+    Containers are keyed by the image and the arguments they were started
+    with, a container is handed out again only to a scenario asking for the
+    same key. Before a container is reused it has to pass the health check
+    (and the optional reset command), after max_uses scenarios it is stopped.
+    """
+
+    TAG = "reuse_container"
+
+    def __init__(self, max_uses=None, reset_cmd=None, health_check=None, discard=None):
+        if max_uses is None:
+            max_uses = int(os.environ.get('CTF_CONTAINER_POOL_MAX_USES', 10))
+        if reset_cmd is None:
+            reset_cmd = os.environ.get('CTF_CONTAINER_POOL_RESET_CMD')
+        self.max_uses = max_uses
+        self.reset_cmd = reset_cmd
+        self.health_check = health_check or self._is_running
+        self.discard = discard
+        self.idle = {}
+        self.logging = logging.getLogger("dock.middleware.pool")
+
+    @staticmethod
+    def key(image_id, method, kwargs):
+        """ Returns the pool key for a container started by method with kwargs """
+        return json.dumps([image_id, method, kwargs], sort_keys=True, default=str)
+
+    @classmethod
+    def requested(cls, context):
+        """ Returns True if the current scenario (or its feature) opted in """
+        return cls.TAG in context.scenario.effective_tags
+
+    def acquire(self, key):
+        """ Returns a healthy idle container for the key or None """
+        containers = self.idle.get(key, [])
+
+        while containers:
+            container = containers.pop()
+            try:
+                if self.health_check(container):
+                    if self.reset_cmd:
+                        container.execute(cmd=self.reset_cmd)
+                    # log steps of the next scenario only see its own output
+                    container.mark_log()
+                    container.pool_uses += 1
+                    self.logging.info("Reusing container '%s' for the %s time" % (
+                        container.container.get('Id'), container.pool_uses))
+                    return container
+                self.logging.info("Container '%s' failed the health check" % container.container.get('Id'))
+            except Exception as e:
+                self.logging.warning("Container '%s' cannot be reused: %s" % (container.container.get('Id'), e))
+            self._discard(container)
+
+        return None
+
+    def add(self, container, key):
+        """ Registers a newly started container with the pool """
+        container.pool_key = key
+        container.pool_uses = 1
+
+    def release(self, container, reusable=True):
+        """
+        Returns the container to the pool after a scenario, or stops it if it
+        must not be reused or already served max_uses scenarios
+        """
+        if not reusable or container.pool_uses >= self.max_uses:
+            self._discard(container)
+            return
+
+        self.idle.setdefault(container.pool_key, []).append(container)
+
+    def shutdown(self):
+        """ Stops all idle containers """
+        for containers in self.idle.values():
+            for container in containers:
+                self._discard(container)
+        self.idle = {}
+
+    def _discard(self, container):
+        try:
+            if self.discard:
+                self.discard(container)
+            else:
+                container.stop()
+        except Exception as e:
+            self.logging.error("Cannot stop container: %s" % e)
+
+    @staticmethod
+    def _is_running(container):
+        return container.inspect()['State']['Running']
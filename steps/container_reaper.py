@@ -0,0 +1,60 @@
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class ContainerReaper(object):
+    """
+    Stops and removes containers in background threads, so the teardown of
+    a scenario does not block the next one. All containers of a scenario are
+    removed in parallel, wait() is the barrier making sure nothing leaks at
+    the end of the run. Time spent removing containers is tracked separately
+    from the scenarios.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = int(os.environ.get('CTF_TEARDOWN_WORKERS', 4))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.removed = 0
+        self.failed = 0
+        self.removal_time = 0.0
+        self.lock = threading.Lock()
+        self.logging = logging.getLogger("dock.middleware.reaper")
+
+    def submit(self, container):
+        """ Schedules the container to be stopped and removed """
+        self.futures.append(self.executor.submit(self._stop, container))
+
+    def _stop(self, container):
+        start_time = time.time()
+        try:
+            container.stop()
+        except Exception as e:
+            self.logging.error("Cannot remove container: %s" % e)
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            duration = time.time() - start_time
+            with self.lock:
+                self.removal_time += duration
+
+        self.logging.info("Container removed in %.2f seconds" % duration)
+        with self.lock:
+            self.removed += 1
+
+    def wait(self):
+        """ Waits until all scheduled containers are removed """
+        wait(self.futures)
+        self.futures = []
+        self.logging.info("Removed %s containers (%s failed), %.2f seconds spent in teardown" % (
+            self.removed, self.failed, self.removal_time))
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown()
@@ -1,23 +1,73 @@
 from behave import when, then, given
+import os
 import time
 import re
 import logging
 from steps import TIMEOUT
-#from container import Container, ExecException
-from podman_container import Container, ExecException
+from container import Container, ExecException, LogCursor
+from instrumentation import timed
+from log_matcher import LogMatcher
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(format=LOG_FORMAT)
 
+# Amount of already scanned log which is scanned again by regex checks, so
+# that matches spanning over two polls are not missed
+LOG_REGEX_OVERLAP = int(os.environ.get('CTF_LOG_REGEX_OVERLAP', 65536))
+
+# How long to wait for the process of a started container and how often to check
+PROCESS_WAIT_TIME = float(os.environ.get('CTF_PROCESS_WAIT_TIME', 10))
+PROCESS_POLL_INTERVAL = float(os.environ.get('CTF_PROCESS_POLL_INTERVAL', 0.2))
+
+# How long a command which printed the looked for phrase gets to exit, it is
+# cancelled as still running after that
+EXEC_EXIT_GRACE = float(os.environ.get('CTF_EXEC_EXIT_GRACE', 1))
+
 
 @when(u'container is ready')
-def container_is_started(context, pname="java"):
-    container = Container(context.config.userdata['IMAGE'], name=context.scenario.name)
-    container.start()
-    context.containers.append(container)
+def container_is_started(context, pname=None):
+    _run_container(context, context.config.userdata['IMAGE'])
     wait_for_process(context, pname)
 
 
+# the table steps are registered before the '{message}' ones which would match them too
+@then(u'container log should contain all of')
+def log_contains_all(context, timeout=TIMEOUT):
+    """
+    Checks that every message or regex from the table (columns 'type'
+    with 'message' or 'regex' and 'value') appears in the container log.
+    All of them are looked for in a single pass over the log.
+    """
+    matcher = LogMatcher(_log_patterns(context))
+    run_log_matches_patterns(context, matcher, timeout)
+
+    missing = matcher.pending()
+    if missing:
+        raise Exception("%s of the expected patterns were not found in the logs: %s (found: %s)" % (
+            len(missing), ", ".join("%s '%s'" % p for p in missing), _format_found(matcher)))
+
+
+@then(u'container log should contain none of')
+def log_contains_none(context, timeout=TIMEOUT):
+    """
+    Checks that no message or regex from the table appears in the container
+    log until the timeout expires, see log_contains_all for the table format.
+    """
+    matcher = LogMatcher(_log_patterns(context))
+
+    if run_log_matches_patterns(context, matcher, timeout, stop_on_first=True):
+        raise Exception("Patterns were found in the logs but they shoudn't be there: %s" % _format_found(matcher))
+
+
+@then(u'available container log should contain none of')
+def available_log_contains_none(context):
+    """
+    This will check only *once* that no message or regex from the table
+    is in the container log.
+    """
+    log_contains_none(context, timeout=0)
+
+
 @then(u'container log should match regex {regex}')
 def log_matches_regex(context, regex, timeout=TIMEOUT):
     if not run_log_matches_regex(context, regex, timeout):
@@ -69,35 +119,40 @@ def available_log_not_contains_msg(context, message):
         raise Exception("Message '%s' was found in the logs but it shoudn't be there" % message)
 
 
+def _log_patterns(context):
+    return [(row.get('type', 'message'), row['value']) for row in context.table]
+
+
+def _format_found(matcher):
+    return ", ".join("%s '%s' at offset %s" % (kind, text, offset)
+                     for (kind, text), offset in sorted(matcher.found.items(), key=lambda f: f[1])) or "none"
+
+
 @given(u'container is started with env')
 @when(u'container is started with env')
 @when(u'container is started with env with process {pname}')
-def start_container(context, pname="java"):
+def start_container(context, pname=None):
     env = {}
     for row in context.table:
         env[row['variable']] = row['value']
-    container = Container(context.config.userdata['IMAGE'], name=context.scenario.name)
-    container.start(environment=env)
-    context.containers.append(container)
+    _run_container(context, context.config.userdata['IMAGE'], environment=env)
     wait_for_process(context, pname)
 
 
 @given(u'container is started with args')
 @when(u'container is started with args')
-def start_container_with_args(context, pname="java"):
+def start_container_with_args(context, pname=None):
     kwargs = {}
     for row in context.table:
         kwargs[row['arg']] = row['value']
-    container = Container(context.config.userdata['IMAGE'], name=context.scenario.name)
-    container.start(**kwargs)
-    context.containers.append(container)
+    _run_container(context, context.config.userdata['IMAGE'], **kwargs)
     wait_for_process(context, pname)
 
 
 @given(u'container is started with command {cmd}')
 @when(u'container is started with command {cmd}')
 @when(u'container {name} is started with command {cmd}')
-def start_container_with_command(context, cmd, name="", pname="java"):
+def start_container_with_command(context, cmd, name="", pname=None):
     """
     This will start a container with a specific command provided by the user
     Useful for container that does not have an entrypoint or does not executes nothing
@@ -108,11 +163,9 @@ def start_container_with_command(context, cmd, name="", pname="java"):
         for row in context.table:
             env[row['variable']] = row['value']
 
-    container = Container(name + context.config.userdata['IMAGE'], name=context.scenario.name)
     kwargs = {"command": cmd, "environment": env}
-    container.startWithCommand(**kwargs)
+    _run_container(context, name + context.config.userdata['IMAGE'], method="startWithCommand", **kwargs)
 
-    context.containers.append(container)
     wait_for_process(context, pname)
 
 
@@ -123,7 +176,7 @@ def image(context):
 
 @given(u'container is started with args and env')
 @when(u'container is started with args and env')
-def start_container_with_args_and_env(context, pname="java"):
+def start_container_with_args_and_env(context, pname=None):
     kwargs = {}
     env = {}
     for row in context.table:
@@ -134,61 +187,136 @@ def start_container_with_args_and_env(context, pname="java"):
         else:
             raise Exception("Invalid argument or variable '%s', it should prefixed with 'arg' for arguments or 'env' "
                             "for variables" % row['arg_env'])
-    container = Container(context.config.userdata['IMAGE'], name=context.scenario.name)
-    container.start(environment=env, **kwargs)
-    context.containers.append(container)
+    _run_container(context, context.config.userdata['IMAGE'], environment=env, **kwargs)
     wait_for_process(context, pname)
 
 
 @given(u'container is started as uid {uid}')
 @when(u'container is started as uid {uid}')
 @when(u'container is started as uid {uid} with process {pname}')
-def start_container(context, uid, pname="java"):
+def start_container(context, uid, pname=None):
     # we get UID as string from behave, so we compare to string "0" for python3 compatibility
     if uid < "0":
         raise Exception("UID %d is negative" % uid)
-    container = Container(context.config.userdata['IMAGE'], save_output=False, name=context.scenario.name)
-    container.start(user=uid)
-    context.containers.append(container)
+    _run_container(context, context.config.userdata['IMAGE'], save_output=False, user=uid)
     wait_for_process(context, pname)
 
 
-def wait_for_process(context, pname):
+def _run_container(context, image_id, method="start", save_output=True, **kwargs):
+    """
+    Starts a container with the given method and kwargs and appends it to
+    context.containers. Scenarios tagged with @reuse_container get a running
+    container from the pool if one was started the same way before.
+    """
+    pool = getattr(context, 'container_pool', None)
+    key = None
+
+    if pool and pool.requested(context):
+        key = pool.key(image_id, method, kwargs)
+        container = pool.acquire(key)
+        if container:
+            context.containers.append(container)
+            return container
+
+    container = Container(image_id, save_output=save_output, name=context.scenario.name)
+    getattr(container, method)(**kwargs)
+    if key:
+        pool.add(container, key)
+    context.containers.append(container)
+    return container
+
+
+def wait_for_process(context, pname=None):
     """
-    Methods which runs ps in a container looking fo
-    given process
+    Waits until the given process runs in the container. The process list
+    comes from the container engine, so the image does not need 'ps'.
+    Fails if the process does not appear in CTF_PROCESS_WAIT_TIME seconds;
+    when the step did not name a process 'java' is waited for, but a missing
+    one is only logged as not every image runs java.
     """
+    required = pname is not None
+    pname = pname or "java"
+    container = context.containers[-1]
     start_time = time.time()
-    timeout = 10
-    while time.time() < start_time + timeout:
-        try:
-            run_command_immediately_expect_message(context, "ps -C %s" % pname, pname)
-            return
-        except:
-            time.sleep(1)
+
+    with timed('lifecycle', 'ready', container=container.container.get('Id'), process=pname):
+        while True:
+            if _process_running(container, pname):
+                container.process_start_times[pname] = time.time() - container.started_at
+                logging.info("Process %s is running %.3f seconds after the container start" % (
+                    pname, container.process_start_times[pname]))
+                return True
+            if time.time() >= start_time + PROCESS_WAIT_TIME:
+                break
+            time.sleep(PROCESS_POLL_INTERVAL)
+
+    if required:
+        raise Exception("Process %s did not start in %s seconds" % (pname, PROCESS_WAIT_TIME))
+    logging.warning("Process %s did not start in %s seconds" % (pname, PROCESS_WAIT_TIME))
+    return False
+
+
+def _process_running(container, pname):
+    try:
+        # ps -C compares the command name, which is cut to 15 characters
+        return any(name[:15] == pname[:15] for name in container.processes())
+    except Exception as e:
+        logging.debug("Cannot list processes of the container: %s" % e)
+        return False
 
 
 def run_log_matches_regex(context, regex, timeout):
     """
     check the container log output against a regex. It uses
-    optional timeout mechanism.
+    optional timeout mechanism. Only the output which was not
+    scanned yet (plus LOG_REGEX_OVERLAP bytes) is checked on every poll.
     """
     start_time = time.time()
     container = context.containers[-1]
+    pattern = re.compile(regex.encode('utf-8'), re.MULTILINE)
+    cursor = LogCursor(container, overlap=LOG_REGEX_OVERLAP, align_lines=True)
+    if timeout:
+        container.follow_output()
 
     while True:
-        logs = container.get_output().decode()
-        if re.search(regex, logs, re.MULTILINE):
+        logs, _ = cursor.read()
+        if pattern.search(logs):
             logging.info("regex '%s' matched the logs" % regex)
             return True
-        if time.time() > start_time + timeout:
+        remaining = start_time + timeout - time.time()
+        if remaining <= 0:
             break
-        # TODO: Add customization option for sleep time
-        time.sleep(1)
+        cursor.wait(remaining)
     else:
         return False
 
 
+def run_log_matches_patterns(context, matcher, timeout, stop_on_first=False):
+    """
+    Scans the container log with a LogMatcher until all of its patterns were
+    found (or any, with stop_on_first) or the timeout expires. Every chunk
+    of the log is scanned once for all the patterns. Returns True if the
+    wait was satisfied.
+    """
+    start_time = time.time()
+    container = context.containers[-1]
+    cursor = LogCursor(container, overlap=LOG_REGEX_OVERLAP if matcher.align_lines else matcher.overlap,
+                       align_lines=matcher.align_lines)
+    if timeout:
+        container.follow_output()
+
+    while True:
+        logs, start = cursor.read()
+        for (kind, text), offset in matcher.scan(logs, start).items():
+            logging.info("%s '%s' was found in the logs at offset %s" % (kind.capitalize(), text, offset))
+        if not matcher.pending() or (stop_on_first and matcher.found):
+            return True
+        remaining = start_time + timeout - time.time()
+        if remaining <= 0:
+            return False
+        cursor.wait(remaining)
+
+
 def run_log_contains_msg(context, message, timeout):
     """
     Main method that handles checking the container log
@@ -199,17 +327,21 @@ def run_log_contains_msg(context, message, timeout):
 
     start_time = time.time()
     container = context.containers[-1]
+    needle = message.encode('utf-8')
+    cursor = LogCursor(container, overlap=max(len(needle) - 1, 0))
+    if timeout:
+        container.follow_output()
 
     while True:
-        logs = container.get_output()
-        if message in logs:
+        logs, _ = cursor.read()
+        if needle in logs:
             print("---------__" + message)
             logging.info("Message '%s' was found in the logs" % message)
             return True
-        if time.time() > start_time + timeout:
+        remaining = start_time + timeout - time.time()
+        if remaining <= 0:
             break
-        # TODO: Add customization option for sleep time
-        time.sleep(1)
+        cursor.wait(remaining)
     else:
         return False
 
@@ -223,23 +355,34 @@ def run_log_contains_msg_multiple_times(context, message, num, timeout):
 
     start_time = time.time()
     container = context.containers[-1]
+    needle = message.encode('utf-8')
+    cursor = LogCursor(container, overlap=max(len(needle) - 1, 0))
+    if timeout:
+        container.follow_output()
     expected = int(num)
     count = 0
+    # absolute log offset where the next occurrence may start, occurrences
+    # do not overlap (same as str.count)
+    position = 0
     while True:
-        logs = container.get_output().decode()
-        count = logs.count(message)
+        logs, start = cursor.read()
+        index = logs.find(needle, max(position - start, 0))
+        while index >= 0:
+            count += 1
+            position = start + index + len(needle)
+            index = logs.find(needle, position - start)
         if count > expected:
             logging.info("Message '%s' was found in the logs %d times although expected is %d" % (message, count, expected))
             return False  
-        if time.time() > start_time + timeout:
+        remaining = start_time + timeout - time.time()
+        if remaining <= 0:
             if count == expected:
                 logging.info("Message '%s' was found in the logs %d times" % (message, expected))
                 return True
             else:
                 logging.info("Message '%s' was found in the logs %d times although expected is %d" % (message, count, expected))
                 break
-        # TODO: Add customization option for sleep time
-        time.sleep(1)
+        cursor.wait(remaining)
     else:
         return False
 
@@ -251,12 +394,22 @@ def check_that_paths_are_writeable(context, path):
     user = container.execute(cmd="id -u").strip().decode()
     group = container.execute(cmd="id -g").strip().decode()
 
-    output = container.execute(cmd="find %s ! ( ( -user %s -perm -u=w ) -o ( -group %s -perm -g=w ) ) -ls" % (path, user, group))
+    cmd = "find %s ! ( ( -user %s -perm -u=w ) -o ( -group %s -perm -g=w ) ) -ls" % (path, user, group)
+    stream = container.execute_stream(cmd)
 
-    if len(output) is 0:
-        return True
+    try:
+        for output in stream:
+            if output:
+                # a single file is enough, the rest of the listing is not read
+                raise Exception("Not all files on %s path are writeable by %s user or %s group" % (path, user, group), output)
+    finally:
+        stream.close()
 
-    raise Exception("Not all files on %s path are writeable by %s user or %s group" % (path, user, group), output)
+    retcode = stream.exit_code()
+    if retcode != 0:
+        raise ExecException("Command %s failed to execute, return code: %s" % (cmd, retcode))
+
+    return True
 
 
 @then(u'run {cmd} in container and immediately check its output for {output_phrase}')
@@ -298,32 +451,91 @@ def run_command_and_detach(context, cmd):
 @then(u'run {cmd} in container and check its output contains {output_phrase}')
 @then(u'run {cmd} in container')
 def run_command_expect_message(context, cmd, output_phrase, timeout=80):
+    """
+    Runs cmd until its output contains the phrase, for up to timeout seconds.
+    The command gets CTF_EXEC_EXIT_GRACE seconds to exit after the phrase
+    appears, it fails when it exits with an error and is cancelled when it
+    still runs. The 'does not
+    contain' steps pass when this one fails.
+    """
     start_time = time.time()
 
     container = context.containers[-1]
 
     # If timeout is set to 0, then we'll run the specific command only once
     if timeout == 0:
-        last_output = container.execute(cmd=cmd).decode()
-        if (not output_phrase) or output_phrase in last_output:
+        found, last_output = run_command_look_for(container, cmd, output_phrase)
+        if found:
             return True
     else:
         while time.time() < start_time + timeout:
             last_output = None
             try:
-                output = container.execute(cmd=cmd).decode()
-                if output_phrase in output:
+                found, _ = run_command_look_for(container, cmd, output_phrase)
+                if found:
                     return True
             except ExecException as e:
                 last_output = e.output
-                time.sleep(1)
+            time.sleep(1)
+    if isinstance(last_output, bytes):
+        last_output = last_output.decode('utf-8', 'replace')
     raise Exception("Phrase '%s' was not found in the output of running the '%s' command" % (output_phrase, cmd), last_output)
 
 
+def run_command_look_for(container, cmd, phrase):
+    """
+    Runs cmd in the container and reads its output only until phrase
+    appears, then the command is cancelled. Returns a (found, output) tuple
+    with the output as bytes, without a phrase the command just has to
+    succeed. Raises ExecException if the command failed before printing the
+    phrase, or if it exits with an error within EXEC_EXIT_GRACE seconds after
+    printing it. A command still running then is cancelled and passes.
+    """
+    needle = phrase.encode('utf-8') if phrase else b''
+    stream = container.execute_stream(cmd)
+    output = bytearray()
+
+    try:
+        for chunk in stream:
+            output.extend(chunk)
+            if needle and needle in output[max(len(output) - len(chunk) - len(needle) + 1, 0):]:
+                try:
+                    retcode = stream.exit_code(timeout=EXEC_EXIT_GRACE)
+                except ExecException:
+                    # still running, it's cancelled below
+                    retcode = 0
+                if retcode:
+                    raise ExecException("Command %s failed to execute, return code: %s" % (cmd, retcode),
+                                        bytes(output))
+                return True, bytes(output)
+    finally:
+        stream.close()
+
+    retcode = stream.exit_code()
+    if retcode != 0:
+        raise ExecException("Command %s failed to execute, return code: %s" % (cmd, retcode), bytes(output))
+
+    return not needle, bytes(output)
+
+
 @then('file {filename} should contain {phrase}')
-def file_should_contain(context, filename, phrase):
+def file_should_contain(context, filename, phrase, timeout=10):
     filename = context.variables.get(filename[1:], filename)
-    run_command_expect_message(context, 'cat %s' % filename, phrase, timeout=10)
+    start_time = time.time()
+    container = context.containers[-1]
+    last_output = None
+
+    while time.time() < start_time + timeout:
+        try:
+            last_output = container.read_file(filename).decode()
+            if phrase in last_output:
+                return True
+        except ExecException as e:
+            last_output = e.output
+        # the file may still be written, read it again from the container
+        container.invalidate_snapshots()
+        time.sleep(1)
+    raise Exception("Phrase '%s' was not found in the output of running the '%s' command" % (phrase, 'cat %s' % filename), last_output)
 
 
 @then('file {filename} should not contain {phrase}')
@@ -331,6 +543,18 @@ def file_should_not_contain(context, filename, phrase):
     filename = context.variables.get(filename[1:], filename)
     run_command_unexpect_message(context, 'cat %s' % filename, phrase, timeout=10)
 
+@given(u'container files under {path} are cached')
+@when(u'container files under {path} are cached')
+def cache_container_files(context, path):
+    """
+    Fetches the whole subtree under {path} at once, the following file checks
+    under it are answered locally until a command runs in the container or
+    the next step phase (given/when/then) starts.
+    """
+    container = context.containers[-1]
+    container.snapshot(path)
+
+
 @then(u'inspect container')
 def inspect_container(context):
     container = context.containers[-1]
@@ -0,0 +1,219 @@
+import os
+import threading
+
+import docker
+
+# API version used to talk to the engine, 'auto' negotiates it with the daemon
+API_VERSION = os.environ.get('CTF_DOCKER_API_VERSION', 'auto')
+
+# Connections to the engine kept open and shared by all threads
+POOL_SIZE = int(os.environ.get('CTF_ENGINE_POOL_SIZE', 10))
+
+# Container engine the steps talk to: docker, podman (through its Docker
+# compatible API socket) or fake (scripted in-memory engine, no daemon)
+ENGINE = os.environ.get('CTF_CONTAINER_ENGINE', 'docker')
+
+# Socket of the podman API service (podman system service)
+PODMAN_SOCKET = os.environ.get('CTF_PODMAN_SOCKET', 'unix:///run/user/%s/podman/podman.sock' % os.getuid())
+
+# Largest block read at once from the output stream of a container with a terminal
+RAW_STREAM_READ_SIZE = 64 * 1024
+
+# Client methods which do not call the engine API, wrappers pass them through
+LOCAL_CALLS = frozenset(['create_host_config'])
+
+_client = None
+_wrappers = []
+_host_config_args = None
+_lock = threading.Lock()
+
+
+class Engine(object):
+    """
+    The part of the docker API client used by the steps. Any object providing
+    these methods (with the docker-py signatures and return values) can be
+    used as the engine, see set_client() and fake_engine.FakeEngine.
+    """
+
+    def create_container(self, image, detach=True, volumes=None, host_config=None, **kwargs):
+        raise NotImplementedError()
+
+    def create_host_config(self, **kwargs):
+        raise NotImplementedError()
+
+    def start(self, container):
+        raise NotImplementedError()
+
+    def kill(self, container):
+        raise NotImplementedError()
+
+    def remove_container(self, container):
+        raise NotImplementedError()
+
+    def inspect_container(self, container):
+        raise NotImplementedError()
+
+    def logs(self, container, stream=False, follow=False, timestamps=False, since=None):
+        raise NotImplementedError()
+
+    def attach(self, container, stream=False, logs=True):
+        raise NotImplementedError()
+
+    def exec_create(self, container, cmd):
+        raise NotImplementedError()
+
+    def exec_start(self, exec_id, detach=False, stream=False, demux=False):
+        raise NotImplementedError()
+
+    def exec_inspect(self, exec_id):
+        raise NotImplementedError()
+
+    def top(self, container, ps_args=None):
+        raise NotImplementedError()
+
+    def put_archive(self, container, path, data):
+        raise NotImplementedError()
+
+    def get_archive(self, container, path):
+        raise NotImplementedError()
+
+    def stat_archive(self, container, path):
+        """ Returns the stat of the path like get_archive, without its content """
+        raise NotImplementedError()
+
+    def inspect_image(self, image):
+        raise NotImplementedError()
+
+    def history(self, image):
+        raise NotImplementedError()
+
+    def tag(self, image, repository, tag=None, force=False):
+        raise NotImplementedError()
+
+    def remove_image(self, image, force=False):
+        raise NotImplementedError()
+
+
+class ArchiveStat(object):
+    """
+    Adds stat_archive() to the docker-py client. It asks for the stat of a
+    path with the HEAD request of the archive API, so the daemon does not
+    build the tar of a whole directory just to tell it exists.
+    """
+
+    def stat_archive(self, container, path):
+        if isinstance(container, dict):
+            container = container.get('Id')
+        res = self.head(self._url('/containers/{0}/archive', container), params={'path': path},
+                        timeout=self.timeout)
+        self._raise_for_status(res)
+        encoded_stat = res.headers.get('x-docker-container-path-stat')
+        return docker.utils.decode_json_header(encoded_stat) if encoded_stat else None
+
+
+class RawStream(object):
+    """
+    Streams the output of containers with a terminal (followed logs, attach)
+    in the blocks the engine sent, docker-py reads it byte by byte and every
+    byte then goes through the log follower separately.
+    """
+
+    def _stream_raw_result(self, response, chunk_size=1, decode=True):
+        if chunk_size != 1 or not hasattr(response.raw, 'read1'):
+            # archives are read in big chunks already, urllib3 < 2.0 has no read1
+            # (docker-py < 3.0 has no chunk_size and decode arguments)
+            args = (chunk_size, decode) if (chunk_size, decode) != (1, True) else ()
+            for chunk in super(RawStream, self)._stream_raw_result(response, *args):
+                yield chunk
+            return
+
+        self._raise_for_status(response)
+        self._disable_socket_timeout(self._get_raw_response_socket(response))
+        while True:
+            data = response.raw.read1(RAW_STREAM_READ_SIZE, decode_content=decode)
+            if not data:
+                return
+            yield data
+
+
+def client():
+    """
+    Returns the engine client shared by the whole process. It is created on
+    first use, so importing the steps does not connect to any daemon, and
+    the API version is negotiated only once.
+    """
+    global _client
+
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _wrap(_create_client())
+    return _client
+
+
+def set_client(engine):
+    """
+    Replaces the engine client, e.g. with a scripted FakeEngine in benchmarks
+    or when testing the steps. None makes client() create it again.
+    """
+    global _client
+
+    with _lock:
+        _client = None if engine is None else _wrap(engine)
+
+
+def wrap_client(wrapper):
+    """
+    Registers a function which returns a wrapper of the client passed to it,
+    e.g. to time or trace the engine API calls. It is applied to the current
+    client and to every client created (or set) later.
+    """
+    global _client
+
+    with _lock:
+        _wrappers.append(wrapper)
+        if _client is not None:
+            _client = wrapper(_client)
+
+
+def _wrap(engine):
+    for wrapper in _wrappers:
+        engine = wrapper(engine)
+    return engine
+
+
+def _create_client():
+    if ENGINE == 'fake':
+        from fake_engine import FakeEngine
+        return FakeEngine()
+
+    kwargs = docker.utils.kwargs_from_env()
+    if ENGINE == 'podman':
+        kwargs['base_url'] = PODMAN_SOCKET
+    elif ENGINE != 'docker':
+        raise Exception("Unknown container engine '%s', use docker, podman or fake" % ENGINE)
+
+    if not hasattr(docker, 'APIClient'):
+        # docker-py < 2.0
+        return type('Client', (ArchiveStat, docker.Client), {})(version=API_VERSION, **kwargs)
+
+    api_client = type('APIClient', (ArchiveStat, RawStream, docker.APIClient), {})
+    try:
+        return api_client(version=API_VERSION, max_pool_size=POOL_SIZE, **kwargs)
+    except TypeError:
+        # max_pool_size is not supported before docker-py 3.0
+        return api_client(version=API_VERSION, **kwargs)
+
+
+def host_config_args():
+    """
+    Returns names of the arguments which belong to create_host_config and not
+    to create_container, they are looked up only once
+    """
+    global _host_config_args
+
+    if _host_config_args is None:
+        # be aware - this moved to differnet place for new docker python API
+        names = docker.utils.utils.create_host_config.__code__.co_varnames
+        _host_config_args = frozenset(list(names) + ['cpu_quota', 'cpu_period', 'cpuset_cpus', 'mem_limit'])
+    return _host_config_args
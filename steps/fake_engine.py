@@ -0,0 +1,329 @@
+import collections
+import io
+import itertools
+import posixpath
+import re
+import tarfile
+import threading
+import time
+
+import docker
+
+from engine import Engine
+
+
+class FakeEngine(Engine):
+    """
+    In-process container engine, selected with CTF_CONTAINER_ENGINE=fake or
+    engine.set_client(). Containers do not run anything, their log output,
+    command results, files, processes and image metadata are scripted, so
+    the step logic can be exercised and measured without a daemon.
+
+    Every created container shares the script: log lines become visible
+    `delay` seconds after the container start, commands are answered by the
+    first matching on_exec() rule and the files are the same in every
+    container (put_archive adds to them).
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.log_script = []
+        self.exec_rules = []
+        self.files = {'/': None}
+        self.process_names = []
+        self.containers = {}
+        self.execs = {}
+        self.calls = collections.Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # scripting
+
+    def add_image(self, name, labels=None, layers=None, size=None):
+        """ layers is a list of (size, created_by) tuples, newest first """
+        layers = layers or [(0, '')]
+        self.images[name] = {
+            'Id': 'sha256:%064x' % next(self._ids),
+            'Config': {'Labels': labels or {}},
+            'Size': size if size is not None else sum(layer[0] for layer in layers),
+            'History': [{'Id': '<missing>', 'Size': layer[0], 'CreatedBy': layer[1]} for layer in layers],
+        }
+
+    def add_log(self, line, delay=0):
+        """ Prints line (a newline is added) delay seconds after the container start """
+        self.log_script.append((delay, line.encode('utf-8') + b'\n'))
+
+    def on_exec(self, pattern, output=b'', exit_code=0, delay=0):
+        """ Commands matching the regex pattern print output and exit with exit_code """
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8')
+        self.exec_rules.append((re.compile(pattern), output, exit_code, delay))
+
+    def add_file(self, path, content=b'', link=None):
+        """ Adds a file (with all parent directories), or a symlink to link """
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self._add_parents(path)
+        self.files[posixpath.normpath(path)] = ('link', link) if link else content
+
+    def add_directory(self, path):
+        self._add_parents(path)
+        self.files[posixpath.normpath(path)] = None
+
+    def add_process(self, name):
+        """ name is the command name of the process (comm), as matched by 'ps -C' """
+        self.process_names.append(name)
+
+    def _add_parents(self, path):
+        parent = posixpath.dirname(posixpath.normpath(path))
+        while parent not in self.files:
+            self.files[parent] = None
+            parent = posixpath.dirname(parent)
+
+    # engine interface
+
+    def create_container(self, image, detach=True, volumes=None, host_config=None, **kwargs):
+        self._call('create_container')
+        if image not in self.images:
+            raise docker.errors.NotFound("No such image: %s" % image)
+        container_id = '%064x' % next(self._ids)
+        self.containers[container_id] = {'image': image, 'started': None, 'running': False, 'config': kwargs}
+        return {'Id': container_id}
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def start(self, container):
+        self._call('start')
+        state = self._container(container)
+        state['started'] = time.time()
+        state['running'] = True
+
+    def kill(self, container):
+        self._call('kill')
+        self._container(container)['running'] = False
+
+    def remove_container(self, container):
+        self._call('remove_container')
+        del self.containers[self._id(container)]
+
+    def inspect_container(self, container):
+        self._call('inspect_container')
+        state = self._container(container)
+        return {'Id': self._id(container), 'Image': state['image'],
+                'State': {'Running': state['running']},
+                'Config': state['config'],
+                'NetworkSettings': {'IPAddress': '127.0.0.1'}}
+
+    def logs(self, container, stream=False, follow=False, timestamps=False, since=None, **kwargs):
+        self._call('logs')
+        state = self._container(container)
+
+        if not stream:
+            return b''.join(self._log_lines(state, timestamps, since, time.time()))
+        return self._follow(state, timestamps, since, follow)
+
+    def attach(self, container, stream=False, logs=True, **kwargs):
+        return self.logs(container)
+
+    def exec_create(self, container, cmd, **kwargs):
+        self._call('exec_create')
+        exec_id = '%064x' % next(self._ids)
+        if not isinstance(cmd, str):
+            cmd = ' '.join(cmd)
+        self.execs[exec_id] = {'cmd': cmd, 'exit_code': None}
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, detach=False, stream=False, demux=False, **kwargs):
+        self._call('exec_start')
+        state = self.execs[self._id(exec_id)]
+        output, exit_code, delay = self._run(state['cmd'])
+        if delay:
+            time.sleep(delay)
+        state['exit_code'] = exit_code
+
+        if demux:
+            output = (output, None)
+        if stream:
+            return iter([output]) if output else iter([])
+        return output
+
+    def exec_inspect(self, exec_id):
+        self._call('exec_inspect')
+        state = self.execs[self._id(exec_id)]
+        return {'ExitCode': state['exit_code'], 'Running': state['exit_code'] is None}
+
+    def top(self, container, ps_args=None):
+        self._call('top')
+        self._container(container)
+        if ps_args and 'comm' in ps_args:
+            return {'Titles': ['PID', 'COMMAND'],
+                    'Processes': [[str(pid), name[:15]] for pid, name in enumerate(self.process_names, 1)]}
+        return {'Titles': ['PID', 'CMD'],
+                'Processes': [[str(pid), name] for pid, name in enumerate(self.process_names, 1)]}
+
+    def put_archive(self, container, path, data):
+        self._call('put_archive')
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for member in tar.getmembers():
+                target = posixpath.join(path, member.name)
+                if member.isdir():
+                    self.add_directory(target)
+                elif member.issym():
+                    self.add_file(target, link=member.linkname)
+                else:
+                    self.add_file(target, tar.extractfile(member).read())
+        return True
+
+    def get_archive(self, container, path, **kwargs):
+        self._call('get_archive')
+        path = self._resolve_parents(posixpath.normpath(path))
+        stat = self._stat(path)
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as tar:
+            base = posixpath.dirname(path)
+            for name in sorted(self.files):
+                if name == path or name.startswith(path.rstrip('/') + '/'):
+                    tar.addfile(*self._tar_entry(name, posixpath.relpath(name, base)))
+
+        return iter([data.getvalue()]), stat
+
+    def stat_archive(self, container, path):
+        self._call('stat_archive')
+        return self._stat(self._resolve_parents(posixpath.normpath(path)))
+
+    def _resolve_parents(self, path, depth=0):
+        """ Follows the symlinks among the parents of path, like the archive API """
+        parts = path.strip('/').split('/')
+        parent = '/'
+        for i, name in enumerate(parts[:-1]):
+            parent = posixpath.join(parent, name)
+            entry = self.files.get(parent)
+            if isinstance(entry, tuple) and depth < 8:
+                target = posixpath.join(posixpath.dirname(parent), entry[1], *parts[i + 1:])
+                return self._resolve_parents(posixpath.normpath(target), depth + 1)
+        return path
+
+    def _stat(self, path):
+        if path not in self.files:
+            raise docker.errors.NotFound("Could not find the file %s in container" % path)
+
+        entry = self.files[path]
+        stat = {'name': posixpath.basename(path), 'size': 0, 'mode': 0o755, 'linkTarget': ''}
+        if entry is None:
+            stat['mode'] |= 1 << 31
+        elif isinstance(entry, tuple):
+            stat['mode'] |= 1 << 27
+            stat['linkTarget'] = posixpath.normpath(posixpath.join(posixpath.dirname(path), entry[1]))
+        else:
+            stat['size'] = len(entry)
+        return stat
+
+    def inspect_image(self, image):
+        self._call('inspect_image')
+        metadata = dict(self._image(image))
+        del metadata['History']
+        return metadata
+
+    def history(self, image):
+        self._call('history')
+        return self._image(image)['History']
+
+    def tag(self, image, repository, tag=None, force=False):
+        self._call('tag')
+        self.images["%s:%s" % (repository, tag or 'latest')] = self._image(image)
+        return True
+
+    def remove_image(self, image, force=False):
+        self._call('remove_image')
+        self.images.pop(image, None)
+
+    # helpers
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    @staticmethod
+    def _id(reference):
+        return reference.get('Id') if isinstance(reference, dict) else reference
+
+    def _image(self, image):
+        """ Looks the image up by its name or ID """
+        if image in self.images:
+            return self.images[image]
+        for metadata in self.images.values():
+            if metadata['Id'] == image:
+                return metadata
+        raise docker.errors.NotFound("No such image: %s" % image)
+
+    def _container(self, container):
+        try:
+            return self.containers[self._id(container)]
+        except KeyError:
+            raise docker.errors.NotFound("No such container: %s" % self._id(container))
+
+    def _log_lines(self, state, timestamps, since, now):
+        lines = []
+        if not state['started']:
+            return lines
+        for delay, line in self.log_script:
+            printed = state['started'] + delay
+            if printed > now or (since and printed < int(since)):
+                continue
+            if timestamps:
+                stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(printed))
+                line = ('%s.%09dZ ' % (stamp, int(printed % 1 * 1e9))).encode() + line
+            lines.append(line)
+        return lines
+
+    def _follow(self, state, timestamps, since, follow):
+        sent = 0
+        while True:
+            lines = self._log_lines(state, timestamps, since, time.time())
+            for line in lines[sent:]:
+                yield line
+            sent = len(lines)
+            if not follow or not state['running']:
+                return
+            time.sleep(0.01)
+
+    def _run(self, cmd):
+        for pattern, output, exit_code, delay in self.exec_rules:
+            if pattern.search(cmd):
+                return output, exit_code, delay
+
+        # a few commands used by the steps work on the scripted files
+        args = cmd.split()
+        if args[:1] == ['cat'] and len(args) == 2:
+            entry = self.files.get(posixpath.normpath(args[1]))
+            if isinstance(entry, bytes):
+                return entry, 0, 0
+            return b'cat: %s: No such file or directory\n' % args[1].encode(), 1, 0
+        if args[:1] == ['test'] and len(args) == 3:
+            entry = self.files.get(posixpath.normpath(args[2]), False)
+            result = {'-e': entry is not False, '-d': entry is None,
+                      '-f': isinstance(entry, bytes), '-L': isinstance(entry, tuple)}.get(args[1], False)
+            return b'', 0 if result else 1, 0
+        if args[:2] == ['ps', '-C'] and len(args) == 3:
+            if args[2] in self.process_names:
+                return ('  PID TTY          TIME CMD\n    1 ?        00:00:01 %s\n' % args[2]).encode(), 0, 0
+            return b'  PID TTY          TIME CMD\n', 1, 0
+        if args[:1] == ['id']:
+            return b'1000\n', 0, 0
+        return b'', 0, 0
+
+    def _tar_entry(self, name, arcname):
+        entry = self.files[name]
+        info = tarfile.TarInfo(arcname)
+        info.mode = 0o755
+        if entry is None:
+            info.type = tarfile.DIRTYPE
+            return info, None
+        if isinstance(entry, tuple):
+            info.type = tarfile.SYMTYPE
+            info.linkname = entry[1]
+            return info, None
+        info.size = len(entry)
+        return info, io.BytesIO(entry)
@@ -1,44 +1,119 @@
-import docker
+import json
 import logging
+import os
+import re
 
 
 from behave import then
-
-
-try:
-    DOCKER_CLIENT = docker.Client(version="1.22")
-except:
-    DOCKER_CLIENT = docker.APIClient(version="1.22")
+from engine import client
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(format=LOG_FORMAT)
 
+SIZE_UNITS = {
+    '': 1, 'B': 1,
+    'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3,
+    'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3,
+}
 
-@then(u'the image should contain label {label}')
-@then(u'the image should contain label {label} {check} value {value}')
-def label_exists(context, label, check="with", value=None):
-    metadata = DOCKER_CLIENT.inspect_image(context.config.userdata['IMAGE'])
-    config = metadata['Config']
+# Length of the layer commands shown in the layer breakdown
+CREATED_BY_WIDTH = 100
+
+
+class ImageMetadata(object):
+    """
+    Inspect and history results of the checked images, kept for the whole
+    run by image ID. An image name is resolved to its ID once per scenario,
+    the results are fetched again only when the name was moved to another
+    image in the meantime.
+    """
 
-    try:
-        labels = config['Labels']
-    except KeyError:
-        raise Exception("There are no labels in the %s image" % context.config.userdata['IMAGE'])
+    def __init__(self):
+        self.inspected = {}
+        self.histories = {}
+        self.resolved = {}
+        self.logging = logging.getLogger("dock.middleware.image")
 
-    try:
-        actual_value = labels[label]
-    except KeyError:
-        raise Exception("Label %s was not found in the %s image" % (label, context.config.userdata['IMAGE']))
+    def resolve(self, context, name):
+        """ Returns the ID of the image name in the current scenario """
+        scenario = getattr(context, 'scenario', None)
+        resolved = self.resolved.get(name)
+        if resolved and resolved[0] is scenario:
+            return resolved[1]
+
+        metadata = client().inspect_image(name)
+        image_id = metadata['Id']
+        if resolved and resolved[1] != image_id:
+            self.logging.debug("Image %s changed from %s to %s" % (name, resolved[1], image_id))
+        self.inspected[image_id] = metadata
+        self.resolved[name] = (scenario, image_id)
+        return image_id
+
+    def inspect(self, context, name):
+        return self.inspected[self.resolve(context, name)]
+
+    def history(self, context, name):
+        image_id = self.resolve(context, name)
+        if image_id not in self.histories:
+            self.histories[image_id] = client().history(image_id)
+        return self.histories[image_id]
 
-    if not value:
-        return True
 
+_metadata = ImageMetadata()
+
+
+def image_labels(context):
+    image = context.config.userdata['IMAGE']
+    labels = _metadata.inspect(context, image)['Config'].get('Labels')
+    if labels is None:
+        raise Exception("There are no labels in the %s image" % image)
+    return labels
+
+
+def check_label(labels, label, check="with", value=None):
+    """ Returns why the label does not match or None """
+    if label not in labels:
+        return "Label %s was not found" % label
+
+    actual_value = labels[label]
+    if not value:
+        return None
     if check == "with" and actual_value == value:
-            return True
+        return None
     elif check == "containing" and actual_value.find(value) >= 0:
-            return True
+        return None
+
+    return "The %s label does not contain %s value, current value: %s" % (label, value, actual_value)
 
-    raise Exception("The %s label does not contain %s value, current value: %s" % (label, value, actual_value))
+
+@then(u'the image should contain label {label}')
+@then(u'the image should contain label {label} {check} value {value}')
+def label_exists(context, label, check="with", value=None):
+    error = check_label(image_labels(context), label, check, value)
+    if error:
+        raise Exception("%s in the %s image" % (error, context.config.userdata['IMAGE']))
+    return True
+
+
+@then(u'the image should contain labels')
+def labels_exist(context):
+    """
+    Checks all labels of the table against one inspect of the image. The
+    table has a label column and optionally value and check (with or
+    containing, with by default) columns, all mismatches are reported.
+    """
+    labels = image_labels(context)
+
+    errors = []
+    for row in context.table:
+        error = check_label(labels, row['label'], row.get('check') or "with", row.get('value'))
+        if error:
+            errors.append(error)
+
+    if errors:
+        raise Exception("%s of %s labels do not match in the %s image:\n%s" % (
+            len(errors), len(context.table.rows), context.config.userdata['IMAGE'], "\n".join(errors)))
+    return True
 
 
 @then(u'image should contain {count} layers')
@@ -49,8 +124,107 @@ def check_layers_count(context, count):
 
     https://projects.engineering.redhat.com/browse/APPINFRAT-1097
     """
-    history = DOCKER_CLIENT.history(context.config.userdata['IMAGE'])
+    history = _metadata.history(context, context.config.userdata['IMAGE'])
     if len(history) == int(count):
         return True
 
     raise Exception("Image does not contain %s layers, current number of layers: %s" % (count, len(history)), history)
+
+
+def parse_size(size):
+    """ Parses sizes like 500MB, 1.5 GiB or 1024 (bytes) """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*$', size)
+    if not match or match.group(2).upper() not in SIZE_UNITS:
+        raise Exception("Invalid size %s, use a number with an optional B, KB, MB, GB, KiB, MiB or GiB unit" % size)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ('GB', 'MB', 'KB'):
+        if abs(size) >= SIZE_UNITS[unit]:
+            return "%.1f %s" % (size / float(SIZE_UNITS[unit]), unit)
+    return "%s B" % size
+
+
+def layer_breakdown(history):
+    """ Describes the layers of the image history from the biggest one """
+    lines = []
+    for layer in sorted(history, key=lambda layer: -layer.get('Size', 0)):
+        created_by = " ".join((layer.get('CreatedBy') or '').split())
+        if len(created_by) > CREATED_BY_WIDTH:
+            created_by = created_by[:CREATED_BY_WIDTH - 3] + "..."
+        lines.append("%12s  %s" % (format_size(layer.get('Size', 0)), created_by))
+    return "\n".join(lines)
+
+
+def image_size(context):
+    """ Returns the total size of the image and its history """
+    image = context.config.userdata['IMAGE']
+    return _metadata.inspect(context, image)['Size'], _metadata.history(context, image)
+
+
+@then(u'image size should be less than {size}')
+def check_image_size(context, size):
+    total, history = image_size(context)
+    if total < parse_size(size):
+        return True
+
+    raise Exception("Image size %s is not less than %s, layers:\n%s" % (
+        format_size(total), size, layer_breakdown(history)))
+
+
+@then(u'image should not contain layers bigger than {size}')
+def check_layer_size(context, size):
+    limit = parse_size(size)
+    total, history = image_size(context)
+    bigger = [layer for layer in history if layer.get('Size', 0) > limit]
+    if not bigger:
+        return True
+
+    raise Exception("%s layers are bigger than %s, layers:\n%s" % (len(bigger), size, layer_breakdown(history)))
+
+
+@then(u'save image size baseline to {path}')
+def save_size_baseline(context, path):
+    """ Stores the size and layers of the image for the size growth step """
+    total, history = image_size(context)
+    baseline = {
+        'image': context.config.userdata['IMAGE'],
+        'size': total,
+        'layers': [{'size': layer.get('Size', 0), 'created_by': layer.get('CreatedBy') or ''} for layer in history],
+    }
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+    return True
+
+
+@then(u'image size should not grow more than {growth} over the baseline in {path}')
+def check_size_growth(context, growth, path):
+    """
+    Compares the image size with a baseline saved earlier by the 'save
+    image size baseline' step. The allowed growth is either a percentage
+    of the baseline size (5%) or a size (50MB).
+    """
+    if not os.path.exists(path):
+        raise Exception("There is no image size baseline in %s, save it with the 'save image size baseline' step" % path)
+    with open(path) as f:
+        baseline = json.load(f)
+
+    percentage = re.match(r'^\s*(\d+(?:\.\d+)?)\s*%\s*$', growth)
+    if percentage:
+        allowed = int(baseline['size'] * float(percentage.group(1)) / 100)
+    elif growth.strip().endswith('%'):
+        raise Exception("Invalid size %s, use a percentage like 5%% or a size like 50MB" % growth)
+    else:
+        allowed = parse_size(growth)
+
+    total, history = image_size(context)
+    if total - baseline['size'] <= allowed:
+        return True
+
+    raise Exception("Image size %s grew by %s over the baseline %s of %s (%s allowed), layers:\n%s" % (
+        format_size(total), format_size(total - baseline['size']), format_size(baseline['size']),
+        baseline.get('image'), growth, layer_breakdown(history)))
@@ -0,0 +1,132 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from engine import LOCAL_CALLS, wrap_client
+
+# Directory for the timings of the run, instrumentation is off when not set
+DIRECTORY = os.environ.get('CTF_INSTRUMENTATION_DIR')
+
+_recorder = None
+
+
+class Recorder(object):
+    """
+    Collects timings of steps, container lifecycle phases (create, start,
+    ready, stop, remove) and engine API calls. Every event is appended to
+    timings.jsonl as soon as it is recorded, close() writes the totals to
+    timings.prom in the Prometheus textfile format.
+    """
+
+    def __init__(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.scenario = None
+        self.step = None
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.events = open(os.path.join(directory, 'timings.jsonl'), 'w')
+        self.logging = logging.getLogger("dock.middleware.instrumentation")
+
+    def record(self, kind, name, start, duration, **fields):
+        """ Records an event of the kind (step, lifecycle or api) """
+        event = {'kind': kind, 'name': name, 'start': start, 'duration': duration,
+                 'scenario': self.scenario, 'step': self.step}
+        event.update(fields)
+
+        with self.lock:
+            total = self.totals.setdefault((kind, name), [0, 0.0])
+            total[0] += 1
+            total[1] += duration
+            if self.events:
+                self.events.write(json.dumps(event, default=str) + "\n")
+
+    def close(self):
+        with self.lock:
+            self.events.close()
+            self.events = None
+            totals = sorted(self.totals.items())
+
+        metrics = [
+            ('step', 'ctf_step_duration_seconds', 'step', "Time spent in steps"),
+            ('lifecycle', 'ctf_container_lifecycle_seconds', 'phase', "Time spent in container lifecycle phases"),
+            ('api', 'ctf_engine_api_call_seconds', 'call', "Time spent in container engine API calls"),
+        ]
+        lines = []
+        for kind, metric, label, description in metrics:
+            lines.append("# HELP %s %s" % (metric, description))
+            lines.append("# TYPE %s summary" % metric)
+            for (event_kind, name), (count, duration) in totals:
+                if event_kind == kind:
+                    lines.append('%s_sum{%s="%s"} %f' % (metric, label, _escape(name), duration))
+                    lines.append('%s_count{%s="%s"} %d' % (metric, label, _escape(name), count))
+
+        # written at once, so the textfile collector never reads a partial file
+        path = os.path.join(self.directory, 'timings.prom')
+        with open(path + '.tmp', 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(path + '.tmp', path)
+        self.logging.info("Timings written to %s" % self.directory)
+
+
+class TimedClient(object):
+    """ Wraps the engine client and records the duration of every call """
+
+    def __init__(self, client, recorder):
+        self._client = client
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name in LOCAL_CALLS:
+            return attribute
+
+        def call(*args, **kwargs):
+            with timed('api', name):
+                return attribute(*args, **kwargs)
+        return call
+
+
+def start(directory=DIRECTORY):
+    """ Starts recording when a directory is given, returns the recorder or None """
+    global _recorder
+
+    if directory and _recorder is None:
+        _recorder = Recorder(directory)
+        wrap_client(lambda client: TimedClient(client, _recorder))
+    return _recorder
+
+
+def recorder():
+    return _recorder
+
+
+def stop():
+    global _recorder
+
+    if _recorder:
+        _recorder.close()
+        _recorder = None
+
+
+@contextlib.contextmanager
+def timed(kind, name, **fields):
+    """ Records the duration of the block, it does nothing when recording is off """
+    current = _recorder
+    if current is None:
+        yield
+        return
+
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        current.record(kind, name, start_time, time.time() - start_time, **fields)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
@@ -0,0 +1,88 @@
+import re
+
+
+class LogMatcher(object):
+    """
+    Looks for many phrases and regular expressions in a log at once.
+
+    All patterns which were not found yet are combined into one regular
+    expression, so every chunk of the log is scanned once for all of them
+    (patterns with groups or inline flags cannot be combined and are scanned
+    on their own). The offset of the first match of every pattern is kept
+    in `found` by (kind, text), so a message and a regex with the same text
+    are looked for separately.
+    """
+
+    def __init__(self, patterns):
+        """
+        patterns is a list of (kind, text) tuples where kind is either
+        'message' (a literal phrase) or 'regex'
+        """
+        self.patterns = []
+        self.found = {}
+        self.overlap = 0
+        self.align_lines = False
+        self._combined = {}
+
+        for kind, text in patterns:
+            if kind == 'regex':
+                compiled = re.compile(text.encode('utf-8'), re.MULTILINE)
+                self.align_lines = True
+            elif kind == 'message':
+                compiled = re.compile(re.escape(text.encode('utf-8')))
+                self.overlap = max(self.overlap, len(text.encode('utf-8')) - 1)
+            else:
+                raise Exception("Invalid pattern type '%s', it should be either 'message' or 'regex'" % kind)
+            self.patterns.append((kind, text, compiled))
+
+    def pending(self):
+        """ Returns the (kind, text) of patterns which were not found yet """
+        return [(kind, text) for kind, text, _ in self.patterns if (kind, text) not in self.found]
+
+    def scan(self, data, start=0):
+        """
+        Scans data, which starts at the given offset of the log, for the
+        patterns not found yet. Returns a dict of newly found patterns, as
+        (kind, text), and their offsets.
+        """
+        found = {}
+
+        while True:
+            pending = [p for p in self.patterns if p[:2] not in self.found]
+            if not pending:
+                break
+
+            new = False
+            for combined, members in self._combine(pending):
+                for match in combined.finditer(data):
+                    # more patterns may match at the same position
+                    for kind, text, compiled in members:
+                        if (kind, text) not in self.found and compiled.match(data, match.start()):
+                            self.found[kind, text] = found[kind, text] = start + match.start()
+                            new = True
+
+            # a pattern starting inside the match of another one is hidden
+            # by finditer, rescan for the rest if anything was found
+            if not new:
+                break
+
+        return found
+
+    def _combine(self, pending):
+        key = tuple(pattern[:2] for pattern in pending)
+        if key not in self._combined:
+            groups = []
+            combinable = []
+            for pattern in pending:
+                if pattern[2].groups or pattern[2].pattern.startswith(b'(?'):
+                    groups.append((pattern[2], [pattern]))
+                else:
+                    combinable.append(pattern)
+            if combinable:
+                try:
+                    combined = re.compile(b'|'.join(b'(?:' + p[2].pattern + b')' for p in combinable), re.MULTILINE)
+                    groups.append((combined, combinable))
+                except re.error:
+                    groups.extend((p[2], [p]) for p in combinable)
+            self._combined = {key: groups}
+        return self._combined[key]
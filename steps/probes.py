@@ -0,0 +1,158 @@
+import asyncio
+import errno
+import logging
+import os
+import selectors
+import socket
+import time
+
+# Delay between probes of one endpoint, it doubles after every failed probe
+# up to PROBE_MAX_DELAY
+PROBE_DELAY = float(os.environ.get('CTF_PROBE_DELAY', 0.1))
+PROBE_MAX_DELAY = float(os.environ.get('CTF_PROBE_MAX_DELAY', 1))
+
+# Delay before connecting again to a port which refused the connection
+PORT_POLL_INTERVAL = float(os.environ.get('CTF_PORT_POLL_INTERVAL', 0.1))
+
+
+class Endpoint(object):
+    """
+    A port to probe, with a path it's probed with a HTTP GET request and is
+    ready when it returns expected_status_code (and expected_phrase in the
+    body), without a path it's ready when it accepts connections
+    """
+
+    def __init__(self, port, path=None, expected_status_code=200, expected_phrase=None, timeout=1.0):
+        self.port = int(port)
+        self.path = path
+        self.expected_status_code = int(expected_status_code)
+        self.expected_phrase = expected_phrase
+        self.timeout = float(timeout)
+        self.ready_after = None
+        self.last_error = None
+
+    def __str__(self):
+        if self.path:
+            return "http port %s%s" % (self.port, self.path)
+        return "port %s" % self.port
+
+
+def wait_for_endpoints(ip, endpoints, timeout):
+    """
+    Probes all endpoints concurrently until they are ready or the timeout
+    expires, so the wait takes as long as the slowest endpoint. Sets
+    ready_after (seconds since the start) of every ready endpoint and
+    returns the endpoints which did not become ready.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_probe_all(ip, endpoints, timeout))
+    finally:
+        loop.close()
+
+    return [endpoint for endpoint in endpoints if endpoint.ready_after is None]
+
+
+async def _probe_all(ip, endpoints, timeout):
+    start_time = time.time()
+    await asyncio.gather(*[_probe_until_ready(ip, endpoint, start_time, start_time + timeout)
+                           for endpoint in endpoints])
+
+
+async def _probe_until_ready(ip, endpoint, start_time, deadline):
+    delay = PROBE_DELAY
+
+    while True:
+        try:
+            attempt_timeout = max(min(endpoint.timeout, deadline - time.time()), 0.01)
+            await asyncio.wait_for(_probe(ip, endpoint), attempt_timeout)
+            endpoint.ready_after = time.time() - start_time
+            logging.info("%s is ready after %.3f seconds" % (endpoint, endpoint.ready_after))
+            return
+        except Exception as ex:
+            endpoint.last_error = repr(ex)
+            logging.debug("%s is not ready yet: %s" % (endpoint, endpoint.last_error))
+
+        if time.time() + delay >= deadline:
+            return
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, PROBE_MAX_DELAY)
+
+
+async def _probe(ip, endpoint):
+    reader, writer = await asyncio.open_connection(ip, endpoint.port)
+    try:
+        if not endpoint.path:
+            return
+
+        writer.write(("GET %s HTTP/1.1\r\nHost: %s:%s\r\nConnection: close\r\n\r\n" % (
+            endpoint.path, ip, endpoint.port)).encode())
+        await writer.drain()
+
+        status_line = await reader.readline()
+        parts = status_line.split()
+        if len(parts) < 2 or int(parts[1]) != endpoint.expected_status_code:
+            raise Exception("Unexpected response '%s' (expected status code: %s)" % (
+                status_line.decode(errors='replace').strip(), endpoint.expected_status_code))
+
+        if endpoint.expected_phrase:
+            body = await reader.read()
+            if endpoint.expected_phrase.encode() not in body:
+                raise Exception("Document body does not contain the '%s' phrase" % endpoint.expected_phrase)
+    finally:
+        writer.close()
+
+
+def wait_for_ports(ip, ports, timeout, interval=PORT_POLL_INTERVAL):
+    """
+    Watches all ports at once with non-blocking connects until they accept
+    connections or the timeout expires. Returns a dict with the time (as
+    returned by time.time()) when every open port accepted its first
+    connection, ports which did not open are missing.
+    """
+    deadline = time.time() + timeout
+    opened = {}
+    retry_at = dict((int(port), 0) for port in ports)
+
+    with selectors.DefaultSelector() as selector:
+        while retry_at or selector.get_map():
+            now = time.time()
+            if now >= deadline:
+                break
+
+            for port, when in list(retry_at.items()):
+                if when <= now:
+                    del retry_at[port]
+                    _connect(selector, ip, port, retry_at, now + interval)
+
+            wait = deadline - now
+            if retry_at:
+                wait = min(wait, max(min(retry_at.values()) - now, 0))
+
+            for key, _ in selector.select(wait):
+                sock, port = key.fileobj, key.data
+                selector.unregister(sock)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                sock.close()
+                if error == 0:
+                    opened[port] = time.time()
+                else:
+                    logging.debug("port %s is not open yet: %s" % (port, os.strerror(error)))
+                    retry_at[port] = time.time() + interval
+
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+
+    return opened
+
+
+def _connect(selector, ip, port, retry_at, retry):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    error = sock.connect_ex((ip, port))
+    if error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        selector.register(sock, selectors.EVENT_WRITE, port)
+    else:
+        logging.debug("port %s is not open yet: %s" % (port, os.strerror(error)))
+        sock.close()
+        retry_at[port] = retry
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+
+import docker
+
+from engine import client
+
+# Set to 0 to run every s2i build even when an identical one was done
+ENABLED = os.environ.get('CTF_S2I_CACHE', '1') != '0'
+
+
+class BuildCache(object):
+    """
+    Successful s2i builds of the run keyed by everything their result
+    depends on: the builder (and runtime) image IDs, the application source
+    (the content of a local directory or the commit a git ref resolves to),
+    the environment file and the build flags. A build with a known key is
+    not run again, the image it produced is tagged instead and its log is
+    reused. Incremental builds depend on the previous image and are never
+    cached. Builds started ahead of their steps (see s2i_prebuild) are
+    pending, looking up their key waits for them to finish. The source of
+    an application and ref is identified once per run.
+    """
+
+    def __init__(self):
+        self.builds = {}
+        self.pending = {}
+        self.sources = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.logging = logging.getLogger("dock.middleware.s2i_cache")
+
+    def key(self, builder_image, application, ref, context_dir, env, flags, runtime_image=None):
+        """ Returns the key of a build, None if it cannot be cached """
+        try:
+            digest = hashlib.sha256()
+            digest.update(client().inspect_image(builder_image)['Id'].encode())
+            if runtime_image:
+                digest.update(client().inspect_image(runtime_image)['Id'].encode())
+            digest.update(self.source(application, ref).encode())
+            for value in (context_dir, env, flags):
+                digest.update(b'\0' + value.encode('utf-8'))
+            return digest.hexdigest()
+        except Exception as e:
+            self.logging.info("The build of %s cannot be cached: %s" % (application, e))
+            return None
+
+    def source(self, application, ref):
+        """ Returns the source_digest() of the application ref, it's computed only for the first build """
+        with self.lock:
+            source = self.sources.get((application, ref))
+        if source is None:
+            source = source_digest(application, ref)
+            with self.lock:
+                self.sources[(application, ref)] = source
+        return source
+
+    def get(self, key):
+        """ Returns the (image ID, build log) of a cached build or None """
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future:
+            self.logging.info("Waiting for the build %s started ahead" % key[:12])
+            try:
+                future.result()
+            except Exception as e:
+                self.logging.warning("The build %s started ahead failed: %s" % (key[:12], e))
+
+        with self.lock:
+            build = self.builds.get(key)
+        if build is None:
+            return None
+
+        try:
+            client().inspect_image(build[0])
+        except docker.errors.NotFound:
+            # removed in the meantime
+            with self.lock:
+                self.builds.pop(key, None)
+            return None
+        return build
+
+    def put(self, key, image, log):
+        """ Remembers the image built for the key """
+        try:
+            image_id = client().inspect_image(image)['Id']
+        except Exception as e:
+            self.logging.warning("The build of %s cannot be cached: %s" % (image, e))
+            return
+        with self.lock:
+            self.builds[key] = (image_id, log)
+
+    def add_pending(self, key, future):
+        """ Registers a build running in the background, it calls put() when it succeeds """
+        with self.lock:
+            self.pending[key] = future
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.builds or key in self.pending
+
+    def restore(self, key, image):
+        """ Tags the image of a cached build as image, returns its log or None on a miss """
+        build = self.get(key)
+        if build is None:
+            return None
+
+        repository, tag = docker.utils.parse_repository_tag(image)
+        client().tag(build[0], repository, tag or 'latest', force=True)
+        with self.lock:
+            self.hits += 1
+        self.logging.info("Reusing the build of %s as %s" % (build[0], image))
+        return build[1]
+
+    def holds(self, log):
+        """ Returns True if the log belongs to a cached build, it must not be closed then """
+        with self.lock:
+            return any(build[1] is log for build in self.builds.values())
+
+
+def source_digest(application, ref):
+    """
+    Identifies the application source: a local directory by its content,
+    a git repository by the commit the ref points to
+    """
+    if os.path.isdir(application):
+        commit = ""
+        if os.path.isdir(os.path.join(application, '.git')):
+            # s2i builds a local repository from the ref, not the working tree
+            commit = subprocess.check_output(["git", "-C", application, "rev-parse", ref],
+                                             stderr=subprocess.STDOUT).decode().strip()
+        return "dir:%s:%s:%s" % (ref, commit, tree_digest(application))
+
+    output = subprocess.check_output(["git", "ls-remote", application, ref], stderr=subprocess.STDOUT)
+    refs = dict(reversed(line.split()) for line in output.decode().splitlines() if line.strip())
+    # annotated tags are listed with the commit they point to as tag^{}
+    peeled = dict((name, commit) for name, commit in refs.items() if name.endswith('^{}'))
+    commits = set((peeled or refs).values())
+    if len(commits) != 1:
+        if len(ref) == 40 and not commits:
+            # a commit ID is not listed by ls-remote
+            return "git:%s" % ref
+        raise Exception("ref %s of %s resolves to %s commits" % (ref, application, len(commits)))
+    return "git:%s" % commits.pop()
+
+
+def tree_digest(path):
+    """ Hashes names, modes and contents of all files under path (except .git) """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            digest.update(os.path.relpath(full_path, path).encode('utf-8', 'surrogateescape') + b'\0')
+            if os.path.islink(full_path):
+                digest.update(b'link:' + os.readlink(full_path).encode('utf-8', 'surrogateescape'))
+                continue
+            digest.update(b'%o\0' % os.stat(full_path).st_mode)
+            with open(full_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
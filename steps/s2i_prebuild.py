@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import worker
+from engine import client
+
+# Number of s2i builds run at once ahead of the scenarios, 0 disables it
+WORKERS = int(os.environ.get('CTF_S2I_PREBUILD_WORKERS', 4))
+
+# Steps which build an image that must succeed, failing builds are not run ahead
+BUILD_STEPS = frozenset(['s2i_build', 's2i_build_no_run'])
+
+
+class Prebuild(object):
+    """
+    Runs the distinct s2i builds of the selected scenarios before they start.
+    The 's2i build ...' steps are found in the parsed features with the step
+    registry, so their arguments are resolved exactly as when they run. Each
+    build goes to its own integ-prebuild-<key> image and is registered with
+    the build cache as pending, the step then waits for it (if it did not
+    finish yet) and tags its image as integ-<IMAGE> (see built_image).
+
+    The builds are s2i processes, so they run from a pool of threads each
+    waiting for its process. The integ-prebuild-<key> tags are removed by
+    shutdown(), the images tagged by the steps stay.
+    """
+
+    def __init__(self, cache, workers=WORKERS):
+        self.cache = cache
+        self.workers = workers
+        self.executor = None
+        self.images = []
+        self.lock = threading.Lock()
+        self.logging = logging.getLogger("dock.middleware.s2i_prebuild")
+
+    def start(self, context):
+        """ Submits the builds found in the features selected for the run """
+        if not self.cache or self.workers <= 0:
+            return 0
+
+        try:
+            builds = self.find_builds(context)
+        except Exception as e:
+            # the builds just run in their scenarios
+            self.logging.warning("Cannot find the s2i builds of the run: %s" % e)
+            return 0
+        if not builds:
+            return 0
+
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        submitted = 0
+        for build in builds:
+            key = self.cache.key(build['builder_image'], build['application'], build['tag'], build['path'],
+                                 build['env_content'], build['mirror'], build['runtime_image'])
+            if key is None or key in self.cache:
+                continue
+            self.cache.add_pending(key, self.executor.submit(self._build, key, build))
+            submitted += 1
+
+        self.logging.info("Started %s s2i builds ahead of %s build steps" % (submitted, len(builds)))
+        return submitted
+
+    def find_builds(self, context):
+        """ Returns the arguments of the s2i build steps in the scenarios which will run """
+        from behave.step_registry import registry
+        from s2i_steps import env_file_content, mirror_option
+
+        builds = []
+        builder_image = context.config.userdata.get('IMAGE', 'ctf')
+
+        for feature in context._runner.features:
+            for scenario in feature.walk_scenarios():
+                if hasattr(scenario, 'should_run') and not scenario.should_run(context.config):
+                    continue
+
+                for step in scenario.all_steps:
+                    match = registry.find_match(step)
+                    if match is None or getattr(match.func, '__name__', None) not in BUILD_STEPS:
+                        continue
+
+                    args = dict((argument.name, argument.value) for argument in match.arguments)
+                    if args.get('incremental'):
+                        continue
+                    builds.append({
+                        'builder_image': builder_image,
+                        'application': args['application'],
+                        'path': args.get('path', '.'),
+                        'tag': args.get('tag', 'master'),
+                        'runtime_image': args.get('runtime_image', ''),
+                        'env_content': env_file_content(step.table) if step.table else "",
+                        'mirror': mirror_option(),
+                        'location': str(step.location),
+                    })
+
+        return builds
+
+    def _build(self, key, build):
+        from s2i_steps import build_command, write_env_file
+        from steps import _execute
+
+        env = ""
+        envfile = None
+        if build['env_content']:
+            envfile = write_env_file(build['env_content'])
+            env = '-E "%s"' % envfile.name
+
+        image_id = "integ-prebuild-%s%s" % (worker.PREFIX, key[:16])
+        command = build_command(build['builder_image'], build['application'], build['path'], env, False,
+                                build['tag'], build['runtime_image'], image_id, build['mirror'])
+        self.logging.info("Building %s ahead for %s [%s]" % (image_id, build['location'], command))
+
+        try:
+            log = _execute(command)
+        finally:
+            if envfile:
+                envfile.close()
+
+        if log:
+            with self.lock:
+                self.images.append(image_id)
+            self.cache.put(key, image_id, log)
+        else:
+            self.logging.warning("Build %s failed, it runs again in its scenario" % image_id)
+        return bool(log)
+
+    def shutdown(self):
+        """ Waits for the running builds and removes the tags of all builds done ahead """
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+        with self.lock:
+            images, self.images = self.images, []
+        for image in images:
+            try:
+                client().remove_image(image)
+            except Exception as e:
+                self.logging.warning("Cannot remove the image %s built ahead: %s" % (image, e))
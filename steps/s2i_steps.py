@@ -6,6 +6,7 @@ import tempfile
 
 from container import Container
 from steps import _execute
+import worker
 
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -15,32 +16,77 @@ logging.basicConfig(format=LOG_FORMAT)
 def s2i_inner(context, application, path='.', env="", incremental=False, tag="master", runtime_image=""):
     """Perform an S2I build, that may fail or succeed."""
     # set up the environment option, if supplied
+    env_content = ""
     if context.table:
-        envfile = tempfile.NamedTemporaryFile('w')
-        for row in context.table:
-            envfile.write("%s=%s\n" % (row.get('variable'), row.get('value')))
-        envfile.flush()
+        env_content = env_file_content(context.table)
+        envfile = write_env_file(env_content)
         env = '-E "%s"' % envfile.name
 
     context.image = context.config.userdata.get('IMAGE', 'ctf')
 
-    mirror = ""
+    mirror = mirror_option()
+    image_id = built_image(context)
+    command = build_command(context.image, application, path, env, incremental, tag, runtime_image, image_id, mirror)
+
+    # an identical build done earlier in the run is reused
+    cache = getattr(context, 's2i_cache', None)
+    key = None
+    if cache and not incremental:
+        key = cache.key(context.image, application, tag, path, env_content or env, mirror, runtime_image)
+        log = key and cache.restore(key, image_id)
+        if log:
+            logging.info("Skipping the S2I build, the same build was done already")
+            _set_build_log(context, log)
+            return log
 
-    if os.getenv("MAVEN_MIRROR_URL", False):
-        mirror = "-e 'MAVEN_MIRROR_URL=%s'" % os.getenv("MAVEN_MIRROR_URL")
-        
-    image_id = "integ-" + context.image
-    command = "s2i build --loglevel=5 --pull-policy if-not-present %s --context-dir=%s -r=%s %s %s %s %s %s %s" % (
-        mirror, path, tag, env, application, context.image, image_id, "--incremental" if incremental else "",
-        "--runtime-image="+runtime_image if runtime_image else ""
-    )
     logging.info("Executing new S2I build with the command [%s]..." % command)
 
     output = _execute(command)
     if output:
-        context.config.userdata['s2i_build_log'] = output
+        if key:
+            cache.put(key, image_id, output)
+        _set_build_log(context, output)
     return output
 
+
+def env_file_content(table):
+    return "".join("%s=%s\n" % (row.get('variable'), row.get('value')) for row in table)
+
+
+def write_env_file(content):
+    """ Returns the temporary env file, it's removed when closed (or collected) """
+    envfile = tempfile.NamedTemporaryFile('w')
+    envfile.write(content)
+    envfile.flush()
+    return envfile
+
+
+def mirror_option():
+    if os.getenv("MAVEN_MIRROR_URL", False):
+        return "-e 'MAVEN_MIRROR_URL=%s'" % os.getenv("MAVEN_MIRROR_URL")
+    return ""
+
+
+def built_image(context):
+    """ The image the s2i build steps produce, each parallel worker has its own """
+    return "integ-" + worker.PREFIX + context.image
+
+
+def build_command(builder_image, application, path, env, incremental, tag, runtime_image, image_id, mirror):
+    return "s2i build --loglevel=5 --pull-policy if-not-present %s --context-dir=%s -r=%s %s %s %s %s %s %s" % (
+        mirror, path, tag, env, application, builder_image, image_id, "--incremental" if incremental else "",
+        "--runtime-image="+runtime_image if runtime_image else ""
+    )
+
+
+def _set_build_log(context, log):
+    # the log of the previous build may be in a temporary file, unless it's cached
+    previous = context.config.userdata.get('s2i_build_log')
+    cache = getattr(context, 's2i_cache', None)
+    if hasattr(previous, 'close') and previous is not log and not (cache and cache.holds(previous)):
+        previous.close()
+    context.config.userdata['s2i_build_log'] = log
+
 @given(u's2i build {application} from {path} with env and {incremental} using {tag} without running')
 def s2i_build_no_run(context, application, path='.', env="", incremental=False, tag="master"):
     s2i_build(context, application, path, env, incremental, tag, False, "")
@@ -57,7 +103,7 @@ def s2i_build_no_run(context, application, path='.', env="", incremental=False,
 def s2i_build(context, application, path='.', env="", incremental=False, tag="master", run=True, runtime_image=""):
     """Perform an S2I build, that must succeed."""
     if s2i_inner(context, application, path, env, incremental, tag, runtime_image):
-        image_id = "integ-" + context.image
+        image_id = built_image(context)
         logging.info("S2I build succeeded, image %s was built" % image_id)
         if run:
             container = Container(image_id, name=context.scenario.name)
@@ -83,7 +129,7 @@ def s2i_build_log_should_contain(context, phrase):
 
 @then(u's2i build log should match regex {regex}')
 def s2i_build_log_should_match_regex(context, regex):
-    if re.search(regex, context.config.userdata['s2i_build_log'], re.MULTILINE):
+    if context.config.userdata['s2i_build_log'].search(regex, re.MULTILINE):
         return True
 
     raise Exception("Regex '%s' did not match in the output of S2I" % regex)
@@ -1,14 +1,13 @@
 import subprocess
 import time
 import os
-import requests
 import logging
-import select
-import socket
-import fcntl
+import selectors
 
 from behave import then, given
-from container import ExecException
+from build_log import BuildLog
+from container import ExecException, SnapshotMiss
+from probes import Endpoint, wait_for_endpoints, wait_for_ports
 
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(format=LOG_FORMAT)
@@ -17,11 +16,17 @@ if os.environ.get('CTF_WAIT_TIME'):
 else:
     TIMEOUT = 30
 
+# Bytes read from the output of a command at once
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
 
 def _execute(command, log_output=True):
     """
     Helper method to execute a shell command and redirect the logs to logger
-    with proper log level.
+    with proper log level. Both outputs are read in chunks until they are
+    closed, so nothing printed just before the exit is lost. Returns False
+    if the command failed, otherwise a BuildLog with the output (when
+    log_output is set) or True.
     """
 
     logging.debug("Executing '%s' command..." % command)
@@ -31,41 +36,40 @@ def _execute(command, log_output=True):
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
         levels = {
-            proc.stdout: logging.DEBUG,
-            proc.stderr: logging.ERROR
+            proc.stdout.fileno(): logging.DEBUG,
+            proc.stderr.fileno(): logging.ERROR
         }
-
-        fcntl.fcntl(
-            proc.stderr.fileno(),
-            fcntl.F_SETFL,
-            fcntl.fcntl(proc.stderr.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK,
-        )
-
-        fcntl.fcntl(
-            proc.stdout.fileno(),
-            fcntl.F_SETFL,
-            fcntl.fcntl(proc.stdout.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK,
-        )
-
-        if log_output:
-            out = ""
-
-            while proc.poll() is None:
-                readx = select.select([proc.stdout, proc.stderr], [], [])[0]
-                for output in readx:
-                    line = output.readline()[:-1]
-                    
-                    if isinstance(line, bytes):
-                        line = line.decode("utf-8")
-
-                    out += "%s\n" % line
-                    logging.log(levels[output], line)
-
+        log = BuildLog() if log_output else None
+        pending = dict((fd, b'') for fd in levels)
+
+        with selectors.DefaultSelector() as selector:
+            for fd in levels:
+                selector.register(fd, selectors.EVENT_READ)
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, OUTPUT_CHUNK_SIZE)
+                    data = pending[key.fd] + chunk
+                    if chunk:
+                        # only complete lines are logged, unless a line gets too long
+                        cut = data.rfind(b'\n') + 1
+                        if not cut and len(data) > OUTPUT_CHUNK_SIZE:
+                            cut = len(data)
+                    else:
+                        selector.unregister(key.fd)
+                        cut = len(data)
+                    pending[key.fd] = data[cut:]
+                    _log_lines(data[:cut], levels[key.fd], log)
+
+        proc.stdout.close()
+        proc.stderr.close()
         retcode = proc.wait()
 
-        if retcode is not 0:
+        if retcode != 0:
             logging.error(
                 "Command '%s' returned code was %s, check logs" % (command, retcode))
+            if log:
+                log.close()
             return False
 
     except subprocess.CalledProcessError:
@@ -73,11 +77,25 @@ def _execute(command, log_output=True):
         return False
 
     if log_output:
-        return out
+        return log
     else:
         return True
 
 
+def _log_lines(data, level, log):
+    """
+    Stores the output as it was printed, a piece of a line cut because it
+    was too long is logged as a line of its own
+    """
+    if not data:
+        return
+    if log:
+        log.write(data)
+    if logging.getLogger().isEnabledFor(level):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            logging.log(level, line)
+
+
 @then(u'check that page is not served')
 def check_page_is_not_served(context):
     # set defaults
@@ -171,6 +189,7 @@ def handle_request(context, port, wait, timeout, expected_status_code, path, exp
 
     start_time = time.time()
     ip = context.containers[-1].ip_address
+    session = context.containers[-1].http_session()
     latest_status_code = 0
     auth=None
     headers=None
@@ -183,11 +202,11 @@ def handle_request(context, port, wait, timeout, expected_status_code, path, exp
     while time.time() < start_time + wait:
         try:
             if request_method == 'GET':
-                response = requests.get('http://%s:%s%s' % (ip, port, path),
-                                        timeout=timeout, stream=False, auth=auth)
+                response = session.get('http://%s:%s%s' % (ip, port, path),
+                                       timeout=timeout, stream=False, auth=auth)
             elif request_method == 'POST':
-                response = requests.post('http://%s:%s%s' % (ip, port, path),
-                                         timeout=timeout, stream=False, auth=auth, headers=headers, data=request_body)
+                response = session.post('http://%s:%s%s' % (ip, port, path),
+                                        timeout=timeout, stream=False, auth=auth, headers=headers, data=request_body)
         except Exception as ex:
             # Logging as warning, bcause this does not neccessarily means
             # something bad. For example the server did not boot yet.
@@ -216,23 +235,59 @@ def handle_request(context, port, wait, timeout, expected_status_code, path, exp
     raise Exception("handle_request failed", expected_status_code)
 
 
+@then(u'the following endpoints become available')
+def check_endpoints_available(context):
+    """
+    Probes all endpoints from the table at once. Columns are 'port' and
+    optionally 'path' (probed with HTTP GET, plain TCP connect without it),
+    'expected_status_code', 'expected_phrase' and 'timeout' of one probe.
+    The time it took every endpoint to become ready is logged.
+    """
+    ip = context.containers[-1].ip_address
+    endpoints = []
+    for row in context.table:
+        endpoints.append(Endpoint(row['port'], path=row.get('path') or None,
+                                  expected_status_code=row.get('expected_status_code') or 200,
+                                  expected_phrase=row.get('expected_phrase') or None,
+                                  timeout=row.get('timeout') or 1.0))
+
+    failed = wait_for_endpoints(ip, endpoints, TIMEOUT)
+    if failed:
+        raise Exception("Endpoints did not become available: %s" % "; ".join(
+            "%s (%s)" % (endpoint, endpoint.last_error) for endpoint in failed))
+
+    return True
+
+
 @then(u'check that port {port} is open')
 def check_port_open(context, port):
-    start_time = time.time()
+    return check_ports_open(context, port)
 
-    ip = context.containers[-1].ip_address
-    logging.info("connecting to %s port %s" % (ip, port))
-    while time.time() < start_time + TIMEOUT:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(1)
-            s.connect((ip, int(port)))
-            s.close()
-            return True
-        except Exception as ex:
-            logging.debug("not connected yes %s" % ex)
-        time.sleep(1)
-    raise Exception("Port %s is not open" % port)
+
+@then(u'check that ports {ports} are open')
+def check_ports_open(context, ports):
+    """
+    Waits until all the comma separated ports accept connections. The time
+    each port opened after the container start is logged and kept in the
+    port_open_times of the container.
+    """
+    container = context.containers[-1]
+    ports = [int(port) for port in ports.split(',')]
+
+    logging.info("connecting to %s ports %s" % (container.ip_address, ports))
+    opened = wait_for_ports(container.ip_address, ports, TIMEOUT)
+
+    for port, opened_at in sorted(opened.items()):
+        container.port_open_times[port] = opened_at - container.started_at
+        logging.info("Port %s accepted connections %.3f seconds after the container start" % (
+            port, container.port_open_times[port]))
+
+    closed = [port for port in ports if port not in opened]
+    if len(closed) == 1:
+        raise Exception("Port %s is not open" % closed[0])
+    if closed:
+        raise Exception("Ports %s are not open" % ", ".join(str(port) for port in closed))
+    return True
 
 
 @then(u'file {file_name} should exist')
@@ -241,24 +296,15 @@ def check_port_open(context, port):
 def check_file_exists(context, file_name, file_type=None):
     container = context.containers[-1]
 
-    try:
-        container.execute("test -e %s" % file_name)
-    except ExecException as ex:
-        logging.error(ex.output)
+    if not _test_file(container, "-e", file_name):
         raise Exception("File %s does not exist" % file_name)
 
     if file_type:
         if file_type == "directory":
-            try:
-                container.execute("test -d %s" % file_name)
-            except ExecException as e:
-                logging.error(e.output)
+            if not _test_file(container, "-d", file_name):
                 raise Exception("File %s is not a directory" % file_name)
         elif file_type == "symlink":
-            try:
-                container.execute("test -L %s" % file_name)
-            except ExecException as e:
-                logging.error(e.output)
+            if not _test_file(container, "-L", file_name):
                 raise Exception("File %s is not a symlink" % file_name)
 
     return True
@@ -268,14 +314,39 @@ def check_file_exists(context, file_name, file_type=None):
 def check_file_not_exists(context, file_name):
     container = context.containers[-1]
 
-    try:
-        container.execute("test -e %s" % file_name)
-    except:
+    if not _test_file(container, "-e", file_name):
         return True
 
     raise Exception("File %s exists" % file_name)
 
 
+def _test_file(container, flag, file_name):
+    """
+    Returns the result of 'test <flag> <file_name>' (-e, -d or -L) in the
+    container. It is answered from the cached filesystem snapshot if
+    possible, shell patterns are always evaluated in the container. The
+    snapshot is read with the archive API as root, while 'test' runs as the
+    container user, so a path in a directory the user cannot search is
+    reported as existing.
+    """
+    if not any(c in file_name for c in '*?[]$`~ '):
+        try:
+            if flag == "-L":
+                stat = container.file_stat(file_name)
+                return stat is not None and stat.type == 'symlink'
+            stat = container.file_stat(file_name, follow_symlinks=True)
+            return stat is not None and (flag == "-e" or stat.type == 'directory')
+        except SnapshotMiss:
+            pass
+
+    try:
+        container.execute("test %s %s" % (flag, file_name))
+        return True
+    except ExecException as e:
+        logging.error(e.output)
+        return False
+
+
 @then(u'files at {path} should have count of {count}')
 def check_file_count(context, path, count):
     container = context.containers[-1]
@@ -293,6 +364,96 @@ def check_file_count(context, path, count):
     return True
 
 
+@then(u'the following files should exist')
+def check_files(context):
+    """
+    Checks many files with a single command run in the container. Table
+    columns are 'path' and optionally 'type' (file, directory or symlink),
+    'absent' (true if the file should not exist) and 'count' (number of
+    files at the path).
+    """
+    container = context.containers[-1]
+    rows = [dict((heading, row.get(heading, '')) for heading in ('path', 'type', 'absent', 'count'))
+            for row in context.table]
+
+    output = container.execute(cmd=["sh", "-c", _file_checks_script(rows)])
+    results = _parse_file_checks(rows, output.decode())
+
+    failures = [result for result in results if not result['ok']]
+    for result in results:
+        logging.info("File %s: %s" % (result['path'], result['message']))
+    if failures:
+        raise Exception("%s of %s file checks failed: %s" % (
+            len(failures), len(results), "; ".join("%s: %s" % (f['path'], f['message']) for f in failures)))
+
+    return True
+
+
+def _file_checks_script(rows):
+    """
+    Builds a shell script running the checks for all rows, it prints one
+    '<row> <result> [<value>]' line per row and always succeeds
+    """
+    tests = {'file': '-f', 'directory': '-d', 'symlink': '-L'}
+    lines = []
+
+    for index, row in enumerate(rows):
+        path = row['path']
+        if row['count']:
+            lines.append('if out=$(ls -1 %s 2>/dev/null); then echo "%s count $(printf \'%%s\\n\' "$out" | grep -c .)"; '
+                         'else echo "%s missing"; fi' % (path, index, index))
+        elif _absent(row):
+            lines.append('if test -e %s; then echo "%s exists"; else echo "%s ok"; fi' % (path, index, index))
+        elif row['type']:
+            if row['type'] not in tests:
+                raise Exception("Invalid file type '%s', it should be one of %s" % (row['type'], ", ".join(tests)))
+            lines.append('if ! test -e %s; then echo "%s missing"; elif test %s %s; then echo "%s ok"; '
+                         'else echo "%s type"; fi' % (path, index, tests[row['type']], path, index, index))
+        else:
+            lines.append('if test -e %s; then echo "%s ok"; else echo "%s missing"; fi' % (path, index, index))
+
+    lines.append('true')
+    return "\n".join(lines)
+
+
+def _absent(row):
+    return row['absent'].lower() in ('true', 'yes')
+
+
+def _parse_file_checks(rows, output):
+    """ Returns a list with the result of every row of the table """
+    reported = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].isdigit():
+            reported[int(parts[0])] = parts[1:]
+
+    results = []
+    for index, row in enumerate(rows):
+        status = reported.get(index, ['unknown'])
+        result = {'path': row['path'], 'ok': False}
+
+        if status[0] == 'count':
+            result['count'] = int(status[1])
+            result['ok'] = result['count'] == int(row['count'])
+            result['message'] = "expected %s files, found %s" % (row['count'], result['count'])
+        elif status[0] == 'ok':
+            result['ok'] = True
+            result['message'] = "does not exist" if _absent(row) else "exists"
+        elif status[0] == 'exists':
+            result['message'] = "exists"
+        elif status[0] == 'missing':
+            result['message'] = "does not exist"
+        elif status[0] == 'type':
+            result['message'] = "is not a %s" % row['type']
+        else:
+            result['message'] = "was not checked"
+
+        results.append(result)
+
+    return results
+
+
 @given(u'define variable')
 def step_impl(context):
     for row in context.table:
@@ -0,0 +1,29 @@
+import os
+
+# Set by parallel.py for each worker process, empty when the run is not parallel
+WORKER_ID = os.environ.get('CTF_WORKER_ID', '')
+
+# CPUs (cpuset syntax, e.g. 0-3) and memory limit (e.g. 2g) of the
+# containers started by this worker, unless the step sets its own
+CPUSET = os.environ.get('CTF_WORKER_CPUSET')
+MEMORY = os.environ.get('CTF_WORKER_MEMORY')
+
+# Added to the names of the images built by this worker, so workers
+# building the same image do not overwrite each other's tag
+PREFIX = "w%s-" % WORKER_ID if WORKER_ID else ""
+
+
+def output_dir(base="output"):
+    """ Returns the directory for the saved container logs of this worker """
+    if WORKER_ID:
+        return os.path.join(base, "worker-%s" % WORKER_ID)
+    return base
+
+
+def resource_limits(kwargs):
+    """ Adds the cpuset and memory limit of this worker to container create kwargs """
+    if CPUSET and 'cpuset_cpus' not in kwargs:
+        kwargs['cpuset_cpus'] = CPUSET
+    if MEMORY and 'mem_limit' not in kwargs:
+        kwargs['mem_limit'] = MEMORY
+    return kwargs
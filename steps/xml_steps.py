@@ -1,8 +1,12 @@
 from behave import then, given
 from lxml import etree
+import hashlib
 import time
 from steps import TIMEOUT
 
+# compiled XPath expressions, keyed by the expression and the namespaces
+XPATHS = {}
+
 
 @given('XML namespace {prefix}:{url}')
 def register_xml_namespace(context, prefix, url):
@@ -32,30 +36,17 @@ def check_xpath_internal(context, xml_file, xpath, value, strip, timeout=TIMEOUT
     container = context.containers[-1]
 
     while time.time() < start_time + timeout:
-        content = container.execute(cmd="cat %s" % xml_file)
-        document = etree.fromstring(content)
-
-        if 'xml_namespaces' in context:
-            result = document.xpath(xpath, namespaces=context.xml_namespaces)
-        else:
-            result = document.xpath(xpath)
-
-        if isinstance(result, list):
-            for option in result:
-                if isinstance(option, str):
-                    if compare_strings(str(option), str(value), strip):
-                        return True
-                else:
-                    # We assume here that result is Element class
-                    if compare_strings(option.text, str(value), strip):
-                        return True
-        else:
-            if result == safe_cast_int(result):
-                if safe_cast_int(result) == safe_cast_int(value):
-                    return True
-                if time.time() >= start_time + timeout:
-                    raise Exception('Expected element count of %s but got %s' % (value, result))
+        document = parse_document(container, xml_file)
+        result = evaluate_xpath(context, document, xpath)
 
+        if xpath_result_matches(result, value, strip):
+            return True
+        if not isinstance(result, list) and result == safe_cast_int(result):
+            if time.time() >= start_time + timeout:
+                raise Exception('Expected element count of %s but got %s' % (value, result))
+
+        # the file may still be written, read it again from the container
+        container.invalidate_snapshots()
         time.sleep(1)
 
     raise Exception('XPath expression "%s" did not match "%s"' % (xpath, value))
@@ -67,6 +58,105 @@ def check_xml_element_count(context, xml_file, xpath, count, timeout=TIMEOUT):
     check_xpath_internal(context, xml_file, 'count(' + xpath + ')', count, False, timeout)
 
 
+@then('XML file {xml_file} should satisfy')
+def check_xpaths(context, xml_file, timeout=TIMEOUT):
+    """
+    Checks all XPath expressions from the table against one parsed copy of
+    the file. Table columns are 'xpath', 'value' and optionally 'mode' which
+    is 'value' (default), 'trimmed' or 'count'. Rows which are not satisfied
+    yet are retried until the timeout, rows which passed are not checked again.
+    """
+    timeout = float(timeout)
+    start_time = time.time()
+    container = context.containers[-1]
+
+    pending = []
+    for row in context.table:
+        mode = row.get('mode', 'value') or 'value'
+        if mode not in ('value', 'trimmed', 'count'):
+            raise Exception("Invalid mode '%s', it should be one of value, trimmed or count" % mode)
+        xpath = 'count(' + row['xpath'] + ')' if mode == 'count' else row['xpath']
+        pending.append((xpath, row['value'], mode == 'trimmed'))
+    results = {}
+
+    while True:
+        document = parse_document(container, xml_file)
+
+        for xpath, value, strip in list(pending):
+            results[xpath] = evaluate_xpath(context, document, xpath)
+            if xpath_result_matches(results[xpath], value, strip):
+                pending.remove((xpath, value, strip))
+
+        if not pending:
+            return True
+        if time.time() >= start_time + timeout:
+            break
+
+        # the file may still be written, read it again from the container
+        container.invalidate_snapshots()
+        time.sleep(1)
+
+    raise Exception('%s XPath expressions did not match: %s' % (len(pending), "; ".join(
+        '"%s" expected "%s" but got %s' % (xpath, value, _describe(results[xpath])) for xpath, value, _ in pending)))
+
+
+def evaluate_xpath(context, document, xpath):
+    if 'xml_namespaces' in context:
+        return compile_xpath(xpath, context.xml_namespaces)(document)
+    return compile_xpath(xpath)(document)
+
+
+def xpath_result_matches(result, value, strip):
+    """
+    Returns True if any of the matched strings or elements equals to value,
+    numeric results (element counts) are compared as integers
+    """
+    if isinstance(result, list):
+        for option in result:
+            if isinstance(option, str):
+                if compare_strings(str(option), str(value), strip):
+                    return True
+            else:
+                # We assume here that result is Element class
+                if compare_strings(option.text, str(value), strip):
+                    return True
+    else:
+        if result == safe_cast_int(result):
+            if safe_cast_int(result) == safe_cast_int(value):
+                return True
+    return False
+
+
+def _describe(result):
+    if isinstance(result, list):
+        return "[%s]" % ", ".join('"%s"' % (option if isinstance(option, str) else option.text) for option in result)
+    return str(result)
+
+
+def parse_document(container, xml_file):
+    """
+    Returns the parsed XML file from the container, the file is parsed again
+    only if its content changed since the last time
+    """
+    content = container.read_file(xml_file)
+    digest = hashlib.sha1(content).hexdigest()
+
+    cached = container.documents.get(xml_file)
+    if cached and cached[0] == digest:
+        return cached[1]
+
+    document = etree.fromstring(content)
+    container.documents[xml_file] = (digest, document)
+    return document
+
+
+def compile_xpath(xpath, namespaces=None):
+    key = (xpath, tuple(sorted(namespaces.items())) if namespaces else None)
+    if key not in XPATHS:
+        XPATHS[key] = etree.XPath(xpath, namespaces=namespaces)
+    return XPATHS[key]
+
+
 def safe_cast_int(value, default=None):
     try:
         return int(value)